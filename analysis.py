@@ -2,13 +2,12 @@
 
 """
 用于回测结果的绩效分析、绘图
+PerformanceReport由组合的每日总资产数组及行情数据中已加载的基准收盘价一次性计算全部指标，不再重复读取基准数据
+cal_xxx函数保留用于对单个净值序列（Series）的计算
 """
 
-import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 
 # 用于转换百分数
 def format_percent(num):
@@ -27,18 +26,24 @@ def cal_annualized_volatility(df_networth,trade_days=252):
     else:
         return np.sqrt(trade_days)*np.std(returns)
 
+# 计算最大回撤的位置，返回(最大回撤,起始位置,结束位置)，一次遍历完成
+def cal_drawdown_index(networth):
+    networth = np.asarray(networth,dtype=float)
+    accumulate_max_networth = np.maximum.accumulate(networth)
+    drawdown = (accumulate_max_networth-networth)/accumulate_max_networth
+    md_end = int(np.argmax(drawdown))
+    max_drawdown = drawdown[md_end]
+    if max_drawdown == 0: # 若最大回撤为0，返回空位置
+        return max_drawdown,None,None
+    md_start = int(np.argmax(networth[:md_end])) # 回撤开始于结束前的最高点
+    return max_drawdown,md_start,md_end
+
 # 计算最大回撤
 def cal_drawdown(df_networth):
-    date = list(df_networth.index)
-    accumulate_max_networth = np.maximum.accumulate(df_networth)
-    drawdown = list((accumulate_max_networth-df_networth)/accumulate_max_networth)
-    max_drawdown = max(drawdown)
-    if max_drawdown == 0: # 若最大回撤为0，返回空日期
+    max_drawdown,md_start,md_end = cal_drawdown_index(df_networth)
+    if md_start is None: # 若最大回撤为0，返回空日期
         return max_drawdown,None,None
-    else:
-        md_start_date = date[list(df_networth).index(max(df_networth[0:drawdown.index(max_drawdown)]))]
-        md_end_date = date[drawdown.index(max_drawdown)]
-        return max_drawdown,md_start_date,md_end_date
+    return max_drawdown,df_networth.index[md_start],df_networth.index[md_end]
 
 # 计算夏普比率（假定无风险利率为4%）
 def cal_sharpe_ratio(df_networth,trade_days=252,risk_free=0.04):
@@ -76,68 +81,226 @@ def cal_portfolio_alpha(df_networth,df_networth_benchmark,trade_days=252,risk_fr
     alpha = annualized_returns-(risk_free+beta*(annualized_returns_benchmark-risk_free))
     return alpha
 
+class PerformanceReport(object):
+    """
+    绩效报告：由组合的每日总资产及行情数据中已加载的基准收盘价，一次性计算全部风险指标
+    结果保存在metrics中，to_dict()返回字典（用于参数优化等批量回测）
+    """
+
+    def __init__(self, portfolios, benchmark, trade_days=252, risk_free=0.04):
+        self.trade_days = trade_days
+        self.risk_free = risk_free
+        self.dates = portfolios.get_dates()
+        self.networth = portfolios.get_equity()/portfolios.initial_capital
+
+        # 基准收盘价取自行情面板中与回测日期相同的行，不再读取基准数据文件
+        panel = portfolios.bars.panel
+        start = portfolios.first_index
+        close = panel.fields['close'][start:start+len(self.networth),panel.symbol_index[benchmark]]
+        self.networth_benchmark = close/close[0]
+
+        self.metrics = self.calculate()
+
+    def annualize(self, networth):
+        return (networth[-1]/networth[0]-1)*self.trade_days/len(networth)
+
+    def calculate(self):
+        networth = self.networth
+        returns = networth[1:]/networth[:-1]-1
+        returns_benchmark = self.networth_benchmark[1:]/self.networth_benchmark[:-1]-1
+
+        annualized_returns = self.annualize(networth)
+        benchmark_returns = self.annualize(self.networth_benchmark)
+        std = np.std(returns) if len(returns) > 0 else np.nan
+        volatility = 0 if np.isnan(std) else np.sqrt(self.trade_days)*std
+
+        max_drawdown,self.md_start,self.md_end = cal_drawdown_index(networth)
+        if self.md_start is None:
+            md_start_date,md_end_date = None,None
+        else:
+            md_start_date,md_end_date = str(self.dates[self.md_start]),str(self.dates[self.md_end])
+
+        if std == 0 or np.isnan(std):
+            sharpe_ratio = 0
+        else:
+            sharpe_ratio = (annualized_returns-self.risk_free)/volatility
+        calmar_ratio = 0 if max_drawdown == 0 else annualized_returns/max_drawdown # 最大回撤为0，则Calmar比率无穷大
+        if len(returns) > 1: # 数据不足，不计算协方差
+            beta = np.cov(returns,returns_benchmark)[0,1]/np.cov(returns_benchmark)
+        else:
+            beta = 0
+        alpha = annualized_returns-(self.risk_free+beta*(benchmark_returns-self.risk_free))
+
+        return {'annualized_returns':annualized_returns,
+                'benchmark_returns':benchmark_returns,
+                'annualized_volatility':volatility,
+                'max_drawdown':max_drawdown,
+                'md_start_date':md_start_date,
+                'md_end_date':md_end_date,
+                'sharpe_ratio':sharpe_ratio,
+                'calmar_ratio':calmar_ratio,
+                'beta':beta,
+                'alpha':alpha}
+
+    def to_dict(self):
+        return dict(self.metrics)
+
+    def output(self):
+        """
+        输出风险指标
+        """
+        perf = self.metrics
+        print("==========风险指标==========")
+        print("年化收益率：",format_percent(perf['annualized_returns']))
+        print("基准收益率：",format_percent(perf['benchmark_returns']))
+        print("年化波动率：",format_percent(perf['annualized_volatility']))
+        print('最大回撤：',format_percent(perf['max_drawdown']))
+        print('最大回撤起始：',perf['md_start_date'])
+        print('最大回撤结束：',perf['md_end_date'])
+        print("夏普比率：",format(perf['sharpe_ratio'],'.3f'))
+        print("Calmar比率：",format(perf['calmar_ratio'],'.3f'))
+        print("组合Beta：",format(perf['beta'],'.3f'))
+        print("组合Alpha:",format(perf['alpha'],'.3f'))
+
+    def draw_plot(self, file_name='logs/equity_curve.png'):
+        """
+        绘制净值曲线，标注最大回撤区间（matplotlib仅在绘图时导入）
+        """
+        import matplotlib.pyplot as plt
+        import matplotlib.ticker as ticker
+
+        dates = self.dates.astype(str)
+        fig1 = plt.figure(figsize=(12,6))
+        fig1.patch.set_facecolor('white')
+        ax1 = fig1.add_subplot(111,ylabel='Networth')
+        ax1.set_title("Portfolio Equity Curve")
+        ax1.plot(dates,self.networth,color='red',lw=1)
+        ax1.plot(dates,self.networth_benchmark,color='blue',linestyle='--',lw=0.5)
+        # 设置X轴标签密度
+        trade_days = len(dates)
+        ax1.xaxis.set_major_locator(ticker.MultipleLocator(int(trade_days/10)+1))
+
+        # 标注最大回撤区间
+        if self.md_start is not None:
+            ax1.plot(dates[self.md_start:self.md_end+1],self.networth[self.md_start:self.md_end+1],color='green',lw=1)
+
+        plt.legend(('Equity','Benchmark','Max drawdown')) # 添加图例
+        plt.xticks(rotation=15) # x轴旋转15度
+        plt.grid(True) #显示网格
+        plt.savefig(file_name)  # 回测曲线保存到本地
+        #plt.show()
+        plt.close(fig1)
+
+class OnlineMetrics(object):
+    """
+    逐日增量计算的风险指标，每根K线O(1)：由Portfolio.update_portfolios调用update()
+    收益率均值/方差及与基准的协方差采用Welford算法，同时记录净值高点及最大回撤
+    指标定义与PerformanceReport一致（浮点误差以内），可在回测过程中随时读取，用于提前终止及实时监控
+    """
+
+    def __init__(self, trade_days=252, risk_free=0.04):
+        self.trade_days = trade_days
+        self.risk_free = risk_free
+        self.n = 0 # 净值个数
+        self.first = None # 首日总资产及基准价格
+        self.first_benchmark = None
+        self.last = None
+        self.last_benchmark = None
+        # 收益率的Welford累计量
+        self.mean = 0.
+        self.m2 = 0.
+        self.mean_benchmark = 0.
+        self.m2_benchmark = 0.
+        self.comoment = 0.
+        # 净值高点及最大回撤
+        self.peak = None
+        self.peak_date = None
+        self.max_drawdown = 0.
+        self.md_start_date = None
+        self.md_end_date = None
+
+    def update(self, value, benchmark, date_time=None):
+        """
+        写入当日的总资产及基准价格
+        """
+        value = float(value)
+        benchmark = float(benchmark)
+        self.n += 1
+        if self.n == 1:
+            self.first, self.first_benchmark = value, benchmark
+        else:
+            r = value/self.last-1
+            rb = benchmark/self.last_benchmark-1
+            k = self.n-1 # 收益率个数
+            dr = r-self.mean
+            self.mean += dr/k
+            self.m2 += dr*(r-self.mean)
+            db = rb-self.mean_benchmark
+            self.mean_benchmark += db/k
+            self.m2_benchmark += db*(rb-self.mean_benchmark)
+            self.comoment += dr*(rb-self.mean_benchmark)
+        self.last, self.last_benchmark = value, benchmark
+
+        if self.peak is None or value > self.peak:
+            self.peak, self.peak_date = value, date_time
+        drawdown = (self.peak-value)/self.peak
+        if drawdown > self.max_drawdown:
+            self.max_drawdown = drawdown
+            self.md_start_date, self.md_end_date = self.peak_date, date_time
+
+    @property
+    def networth(self):
+        return self.last/self.first if self.n else 1.
+
+    @property
+    def annualized_returns(self):
+        return (self.last/self.first-1)*self.trade_days/self.n if self.n else 0.
+
+    @property
+    def benchmark_returns(self):
+        return (self.last_benchmark/self.first_benchmark-1)*self.trade_days/self.n if self.n else 0.
+
+    @property
+    def annualized_volatility(self):
+        return np.sqrt(self.trade_days*self.m2/(self.n-1)) if self.n > 1 else 0
+
+    @property
+    def sharpe_ratio(self):
+        volatility = self.annualized_volatility
+        return 0 if volatility == 0 else (self.annualized_returns-self.risk_free)/volatility
+
+    @property
+    def calmar_ratio(self):
+        return 0 if self.max_drawdown == 0 else self.annualized_returns/self.max_drawdown
+
+    @property
+    def beta(self):
+        return self.comoment/self.m2_benchmark if self.n > 2 and self.m2_benchmark > 0 else 0
+
+    @property
+    def alpha(self):
+        return self.annualized_returns-(self.risk_free+self.beta*(self.benchmark_returns-self.risk_free))
+
+    def to_dict(self):
+        return {'annualized_returns':self.annualized_returns,
+                'benchmark_returns':self.benchmark_returns,
+                'annualized_volatility':self.annualized_volatility,
+                'max_drawdown':self.max_drawdown,
+                'md_start_date':self.md_start_date if self.max_drawdown > 0 else None,
+                'md_end_date':self.md_end_date if self.max_drawdown > 0 else None,
+                'sharpe_ratio':self.sharpe_ratio,
+                'calmar_ratio':self.calmar_ratio,
+                'beta':self.beta,
+                'alpha':self.alpha}
+
+# 计算全部风险指标，以字典形式返回（用于参数优化等批量回测）
+def cal_performance(portfolios,benchmark):
+    return PerformanceReport(portfolios,benchmark).to_dict()
+
 # 输出风险指标
 def output_performance(portfolios,benchmark):
-    start_date = portfolios.start_date
-    end_date = portfolios.end_date
-
-    df_benchmark = pd.read_csv('database/sym_data/%s.csv'%benchmark,encoding="gbk").dropna()
-    df_benchmark = df_benchmark[(df_benchmark['date_time']>=start_date)&(df_benchmark['date_time']<=end_date)].reset_index()
-
-    all_holdings = pd.DataFrame(portfolios.all_holdings)
-
-    df = pd.DataFrame()
-    df['date_time'] = all_holdings['date_time']
-    df['networth'] = all_holdings['mkt_value']/portfolios.initial_capital
-    df['networth_benchmark'] = df_benchmark['close']/df_benchmark['close'][0]
-    df.index = df['date_time']
-
-    print("==========风险指标==========")
-    print("年化收益率：",format_percent(cal_annualized_returns(df['networth'])))
-    print("基准收益率：",format_percent(cal_annualized_returns(df['networth_benchmark'])))
-    print("年化波动率：",format_percent(cal_annualized_volatility(df['networth'])))
-    print('最大回撤：',format_percent(cal_drawdown(df['networth'])[0]))
-    print('最大回撤起始：',cal_drawdown(df['networth'])[1])
-    print('最大回撤结束：',cal_drawdown(df['networth'])[2])
-    print("夏普比率：",format(cal_sharpe_ratio(df['networth']),'.3f'))
-    print("Calmar比率：",format(cal_calmar_ratio(df['networth']),'.3f'))
-    print("组合Beta：",format(cal_portfolio_beta(df['networth'],df['networth_benchmark']),'.3f'))
-    print("组合Alpha:",format(cal_portfolio_alpha(df['networth'],df['networth_benchmark']),'.3f'))
+    PerformanceReport(portfolios,benchmark).output()
 
 # 绘制净值曲线
 def draw_plot(portfolios,benchmark):
-    start_date = portfolios.start_date
-    end_date = portfolios.end_date
-
-    df_benchmark = pd.read_csv('database/sym_data/%s.csv'%benchmark,encoding="gbk").dropna()
-    df_benchmark = df_benchmark[(df_benchmark['date_time']>=start_date)&(df_benchmark['date_time']<=end_date)].reset_index()
-
-    all_holdings = pd.DataFrame(portfolios.all_holdings)
-
-    df = pd.DataFrame()
-    df['date_time'] = all_holdings['date_time']
-    df['networth'] = all_holdings['mkt_value']/portfolios.initial_capital
-    df['networth_benchmark'] = df_benchmark['close']/df_benchmark['close'][0]
-
-    fig1 = plt.figure(figsize=(12,6))
-    fig1.patch.set_facecolor('white')
-    ax1 = fig1.add_subplot(111,ylabel='Networth')
-    ax1.set_title("Portfolio Equity Curve")
-    ax1.plot(df['date_time'],df['networth'],color='red',lw=1)
-    ax1.plot(df['date_time'],df['networth_benchmark'],color='blue',linestyle='--',lw=0.5)
-    # 设置X轴标签密度
-    trade_days = len(all_holdings['date_time'])
-    ax1.xaxis.set_major_locator(ticker.MultipleLocator(int(trade_days/10)+1))
-
-    # 标注最大回撤区间
-    if cal_drawdown(df['networth'])[0] != 0:
-        md_start = cal_drawdown(df['networth'])[1]
-        md_end = cal_drawdown(df['networth'])[2]
-        ax1.plot(df['date_time'][md_start:md_end+1],df['networth'][md_start:md_end+1],color='green',lw=1)
-
-    plt.legend(('Equity','Benchmark','Max drawdown')) # 添加图例
-    plt.xticks(rotation=15) # x轴旋转15度
-    plt.grid(True) #显示网格
-    plt.savefig('logs/equity_curve.png')  # 回测曲线保存到本地
-    #plt.show()
-
+    PerformanceReport(portfolios,benchmark).draw_plot()
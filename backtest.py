@@ -15,7 +15,7 @@
 # 进一步优化数据结构：1.portfolio持仓及市值列表；2.broker交易流水记录
 # 测试2015.1-2020.7区间，多股均线策略，优化1耗时47.26秒，优化1+2耗时36.11秒
 
-# 未解决问题1：如果在同一天内买卖调仓，卖出的资金无法及时反映到portfolio的cash
+# 已解决问题1：如果在同一天内买卖调仓，卖出的资金无法及时反映到portfolio的cash
 # 表现：执行handlebar后，同时生成一批OrderEvent，包含买入及卖出
 # 只有全部Order处理完成后，才开始处理Fill（形式为Order-Order-Fill-Fill）
 # 导致买入Order由于策略计算的cash不足而无法执行，实际Fill后cash是足够的
@@ -27,18 +27,23 @@
 # 但是在handlebar中取得的cash依然是错误的，使用依然困难
 # 2. 使用get_mkv取代get_cash
 # 对调仓策略的临时解决方案，但灵活性不如get_cash
+# 解决：事件分发改为event.PriorityEventBus，按FILL>卖出ORDER>买入ORDER>MARKET的优先级处理
+# 形式为先卖后买的Order-Fill-Order-Fill，卖出资金及时回填cash，调仓买入不再因可用资金不足被拒绝
+# 注意：handlebar执行期间委托尚未处理，其中取得的cash仍为调仓前的数值，调仓策略仍建议使用get_mkv
 
-import queue
+import event
 import data
 import strategy
 import portfolio
 import broker
 import analysis
 import ordertype
-import query
-import tushare as ts
+import log
+import stopping
 import time
 
+logger = log.get_logger('backtest')
+
 class ContextInfo(object):
     """
     回测需要使用的基础参数
@@ -51,60 +56,90 @@ class ContextInfo(object):
         self.initial_capital = dict['initial_capital']
         self.commission_rate = dict['commission_rate']
         self.min_commission = dict['min_commission']
+        self.use_cache = dict.get('use_cache',True) # 是否使用行情数据的二进制缓存
+        self.params = dict.get('params',{}) # 策略参数，覆盖策略类中params的默认值
+        # 事件分发模式：'priority'为按优先级分发（回测默认，先卖后买、委托后立即成交）
+        # 'fifo'为按写入顺序分发，'threaded'为线程安全的Queue分发（实盘）
+        self.event_mode = dict.get('event_mode','priority')
+        # 委托撮合模式：'event'为逐笔撮合（每个OrderEvent调用broker.execute_order）
+        # 'batch'为批量撮合（缓存当前K线的全部委托，事件处理完毕后先卖后买一次撮合，见broker.flush_orders）
+        self.order_mode = dict.get('order_mode','event')
+        # 日志级别：'DEBUG'输出逐笔委托及交易信号，'INFO'只输出回测进度，None为不修改当前设置
+        self.log_level = dict.get('log_level',None)
+        # 提前终止条件（见stopping模块），每根K线更新持仓后检查，任一条件满足时终止回测
+        self.stop_conditions = dict.get('stop_conditions',[])
 
 class backtest(object):
 
-    def __init__(self,ContextInfo,Strategy):
+    def __init__(self,ContextInfo,Strategy,panel=None):
         self.Strategy = Strategy
         self.ContextInfo = ContextInfo
+        self.panel = panel # 已加载的行情面板数据，为None时从磁盘读取
+        self.stop_reason = None # 提前终止的原因，回测完整执行时为None
 
     # 执行回测
     def run(self):
         self.t0 = time.time() # 回测起始时间
-        event_queue = queue.Queue() # 创建事件队列
-        #event_queue = queue.PriorityQueue() # 优先队列，用于FILL实时回填
+        self.timings = {} # 各阶段耗时（秒）：load加载行情数据，initialize初始化，loop事件循环
+        if self.ContextInfo.log_level is not None:
+            log.set_level(self.ContextInfo.log_level)
+        # 创建事件分发器
+        if self.ContextInfo.event_mode == 'threaded':
+            event_queue = event.QueueEventBus()
+        elif self.ContextInfo.event_mode == 'fifo':
+            event_queue = event.EventBus()
+        else:
+            event_queue = event.PriorityEventBus()
 
         # 初始化行情数据、持仓列表、交易策略、交易记录
-        bars = data.HistoricDataHandler(event_queue,self.ContextInfo)
+        t = time.perf_counter()
+        bars = data.HistoricDataHandler(event_queue,self.ContextInfo,self.panel)
+        self.timings['load'] = time.perf_counter()-t
+        t = time.perf_counter()
         port = portfolio.Portfolio(event_queue,self.ContextInfo,bars)
         order = ordertype.Order(event_queue,bars,port) # 提供便捷的交易函数，不涉及主循环
         stg = self.Strategy(event_queue,self.ContextInfo,bars,port,order)
         brok = broker.SimulatedExecution(event_queue,self.ContextInfo,bars,port)
         stg.initialize() # 策略初始化函数
-        print("[Initialized]Time:",time.time()-self.t0) # 初始化耗时
+
+        # 按事件类注册处理函数
+        event_queue.register(event.MarketEvent,stg.handlebar) # 基于数据生成市场事件
+        if self.ContextInfo.order_mode == 'batch':
+            event_queue.register(event.OrderEvent,brok.buffer_order) # 缓存委托，K线事件处理完毕后批量撮合
+        else:
+            event_queue.register(event.OrderEvent,brok.execute_order) # 基于策略生成委托事件
+        event_queue.register(event.FillEvent,port.update_fill) # 基于成交生成回报事件
+        event_queue.register(event.FillEvent,brok.update_fill) # 成交已计入持仓，清除broker的待回报变动
+        self.timings['initialize'] = time.perf_counter()-t
+        logger.info("[Initialized]Time: %.2f",time.time()-self.t0) # 初始化耗时
 
         # 事件驱动主循环
+        stop_conditions = self.ContextInfo.stop_conditions
+        self.stop_reason = None
+        t = time.perf_counter()
         while True:
             bars.update_bars()  # 获取新数据
 
             if bars.continue_backtest:
                 port.update_portfolios()  # 更新持仓列表
-                brok.update_temp_pos() # 更新broker的当前持仓（实盘不需要）
             else:
                 break # 数据处理完毕，跳出外循环
 
-            while True: # 处理新数据
-                try:
-                    event = event_queue.get(False) # 获取事件队列
-                except queue.Empty: # 事件队列为空，跳出内循环
+            if stop_conditions:
+                self.stop_reason = stopping.check_stop(stop_conditions,port)
+                if self.stop_reason is not None: # 满足终止条件，保留已有记录作为部分结果
+                    logger.info("[Backtest Stopped]%s %s",port.date_time,self.stop_reason)
                     break
 
-                else: # 处理新事件
-                    if event is not None:
-                        #print(event.type)
-                        if event.type == 'MARKET': # 基于数据生成市场事件
-                            stg.handlebar(event)
-
-                        elif event.type == 'ORDER': # 基于策略生成委托事件
-                            brok.execute_order(event)
-
-                        elif event.type == 'FILL': # 基于成交生成回报事件
-                            port.update_fill(event)
+            event_queue.dispatch() # 处理新数据产生的全部事件
+            while brok.flush_orders(): # 批量撮合模式：撮合当前K线的委托，再处理成交回报
+                event_queue.dispatch()
 
         # 回测结束，保存持仓及交易记录
+        self.timings['loop'] = time.perf_counter()-t
         self.portfolios = port
         self.broker = brok
-        print("[Backtest Finished]Time:",time.time()-self.t0) # 回测累计耗时
+        logger.info("[Backtest Finished]Time: %.2f",time.time()-self.t0) # 回测累计耗时
 
     # 导出回测数据
     def download_data(self):
@@ -113,41 +148,65 @@ class backtest(object):
 
     # 生成绩效分析
     def get_performance(self):
-        analysis.output_performance(self.portfolios,self.ContextInfo.benchmark)
-        analysis.draw_plot(self.portfolios,self.ContextInfo.benchmark)
-'''
-# 使用沪深300股票池
-sym_list = list(ts.get_hs300s()['code'])
-sym_pool = []
-for sym in sym_list:
-    if sym.startswith('6'):
-        ss = sym+'.SH'
-    else:
-        ss = sym+'.SZ'
-    sym_pool.append(ss)
-'''
-# 注意股票池不能有重复代码，否则bar切片数据有误
-#sym_pool = ['000568.SZ','002352.SZ','603259.SH','601318.SH','600030.SH',
-#            '600036.SH','000333.SZ','601888.SH','600887.SH','000651.SZ',
-#            '600276.SH','300059.SZ','300015.SZ']
-#sym_pool = query.get_industry_stock('食品饮料')
-#sym_pool = ['600519.SH','600030.SH','000001.SZ']
-#sym_pool = ['600999.SH']
-sym_pool = ['399300.SZ']
-
-# 设置回测：股票池、基准、回测起止时间
-# 默认初始资金1000000，佣金率0.0003，最低佣金5元
-dict_CI = {"symbol_list":sym_pool,
-           'benchmark':'399300.SZ',
-           'start_date':'2005-01-01',
-           'end_date':'2020-07-31',
-           'initial_capital':10000000,
-           'commission_rate':0.0003,
-           'min_commission':5}
-
-#bt1 = backtest(ContextInfo(dict_CI),strategy.SimpleMovingAverage)
-#bt1 = backtest(ContextInfo(dict_CI),strategy.MachineLearning)
-bt1 = backtest(ContextInfo(dict_CI),strategy.RSRS)
-bt1.run()
-bt1.download_data()
-bt1.get_performance()
\ No newline at end of file
+        report = analysis.PerformanceReport(self.portfolios,self.ContextInfo.benchmark)
+        report.output()
+        report.draw_plot()
+
+if __name__ == '__main__':
+    '''
+    # 使用沪深300股票池（需安装tushare）
+    import tushare as ts
+    sym_list = list(ts.get_hs300s()['code'])
+    sym_pool = []
+    for sym in sym_list:
+        if sym.startswith('6'):
+            ss = sym+'.SH'
+        else:
+            ss = sym+'.SZ'
+        sym_pool.append(ss)
+    '''
+    # 注意股票池不能有重复代码，否则bar切片数据有误
+    #sym_pool = ['000568.SZ','002352.SZ','603259.SH','601318.SH','600030.SH',
+    #            '600036.SH','000333.SZ','601888.SH','600887.SH','000651.SZ',
+    #            '600276.SH','300059.SZ','300015.SZ']
+    #import query
+    #sym_pool = query.get_industry_stock('食品饮料')
+    #sym_pool = ['600519.SH','600030.SH','000001.SZ']
+    #sym_pool = ['600999.SH']
+    sym_pool = ['399300.SZ']
+
+    # 设置回测：股票池、基准、回测起止时间
+    # 默认初始资金1000000，佣金率0.0003，最低佣金5元
+    dict_CI = {"symbol_list":sym_pool,
+               'benchmark':'399300.SZ',
+               'start_date':'2005-01-01',
+               'end_date':'2020-07-31',
+               'initial_capital':10000000,
+               'commission_rate':0.0003,
+               'min_commission':5,
+               'log_level':'DEBUG'}
+
+    #bt1 = backtest(ContextInfo(dict_CI),strategy.SimpleMovingAverage)
+    #bt1 = backtest(ContextInfo(dict_CI),strategy.MachineLearning)
+    bt1 = backtest(ContextInfo(dict_CI),strategy.RSRS)
+    bt1.run()
+    bt1.download_data()
+    bt1.get_performance()
+
+    # 参数优化：行情数据只加载一次，各参数组合在进程池中并行回测
+    #import sweep
+    #ps = sweep.ParameterSweep(ContextInfo(dict_CI),strategy.RSRS,{'N':[100,200,300],'threshold':[0.7,0.8,0.9]})
+    #print(ps.run())
+    # 逐次减半：先用较短区间淘汰参数组合，回撤超过50%的组合提前终止
+    #import stopping
+    #dict_CI['stop_conditions'] = [stopping.MaxDrawdownStop(0.5),stopping.MinNetworthStop(0.5)]
+    #sh = sweep.SuccessiveHalving(ContextInfo(dict_CI),strategy.RSRS,{'N':[100,200,300],'threshold':[0.7,0.8,0.9]})
+    #print(sh.run())
+
+    # 向量化回测：目标权重矩阵（日期×代码）的策略不经过事件循环，结果与strategy.TargetWeight一致
+    #import vectorized
+    #import pandas as pd
+    #weights = pd.DataFrame({'399300.SZ':1.},index=['2005-01-04'])
+    #vb = vectorized.VectorizedBacktest(ContextInfo(dict_CI),weights)
+    #vb.run()
+    #vb.get_performance()
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+"""
+回测框架的性能基准测试
+bench_event_dispatch：事件分发微基准，不涉及具体的回测流程
+run_suite：完整回测基准，生成指定规模的合成行情数据（sym_data格式，写入临时目录），
+分别运行均线、RSRS及调仓策略，记录各阶段耗时（加载、初始化、主循环、绩效分析）、每秒处理的事件数及内存峰值，
+结果为JSON，可保存后在不同版本间比较；--check时同时校验调仓策略在事件驱动与向量化回测中的结果一致
+命令行：python benchmark.py --symbols 10 300 3000 --years 15 --output bench.json
+"""
+
+import os
+import sys
+import json
+import queue
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import event
+import cache
+import analysis
+import backtest
+import strategy
+import vectorized
+
+try:
+    import resource
+except ImportError: # Windows下不统计内存峰值
+    resource = None
+
+BENCHMARK = '399300.SZ' # 合成数据的基准代码
+TRADE_DAYS = 252 # 每年交易日数
+REBALANCE_DAYS = 21 # 调仓策略的调仓间隔（交易日）
+CASES = ('sma', 'rsrs', 'rebalance', 'vectorized')
+
+def bench_event_dispatch(n_bars=100000, orders_per_bar=2):
+    """
+    事件分发微基准：每根K线产生1个MARKET事件，每个MARKET产生orders_per_bar个ORDER，
+    每个ORDER产生1个FILL，处理函数不做其他工作，比较每秒处理的事件数
+    queue：原主循环（queue.Queue + get(False)/queue.Empty + 字符串比较event.type）
+    eventbus：event.EventBus（deque + 按事件类注册处理函数）
+    priority：event.PriorityEventBus（heapq，先卖后买、委托后立即成交）
+    """
+    n_events = n_bars*(1+2*orders_per_bar)
+    result = {}
+
+    # 原主循环
+    events = queue.Queue()
+    def on_market(e):
+        for _ in range(orders_per_bar):
+            events.put(event.OrderEvent('000001.SZ', 100))
+    def on_order(e):
+        events.put(event.FillEvent(e.symbol, e.order_amount, 10., 5.))
+    def on_fill(e):
+        pass
+    t0 = time.perf_counter()
+    for _ in range(n_bars):
+        events.put(event.MarketEvent())
+        while True:
+            try:
+                e = events.get(False)
+            except queue.Empty:
+                break
+            else:
+                if e is not None:
+                    if e.type == 'MARKET':
+                        on_market(e)
+                    elif e.type == 'ORDER':
+                        on_order(e)
+                    elif e.type == 'FILL':
+                        on_fill(e)
+    result['queue'] = n_events/(time.perf_counter()-t0)
+
+    # EventBus及PriorityEventBus
+    for name, bus_cls in (('eventbus', event.EventBus), ('priority', event.PriorityEventBus)):
+        bus = bus_cls()
+        def on_market(e):
+            for _ in range(orders_per_bar):
+                bus.put(event.OrderEvent('000001.SZ', 100))
+        def on_order(e):
+            bus.put(event.FillEvent(e.symbol, e.order_amount, 10., 5.))
+        bus.register(event.MarketEvent, on_market)
+        bus.register(event.OrderEvent, on_order)
+        bus.register(event.FillEvent, on_fill)
+        t0 = time.perf_counter()
+        for _ in range(n_bars):
+            bus.put(event.MarketEvent())
+            bus.dispatch()
+        result[name] = n_events/(time.perf_counter()-t0)
+
+    return result
+
+def write_symbol(sym_path, sym, name, dates, rng, vol=0.02, suspend_rate=0.005):
+    """
+    生成单只股票的合成日线（对数正态随机游走，涨跌幅限制±10%，随机停牌），按sym_data格式写入CSV
+    """
+    n = len(dates)
+    ret = np.clip(rng.normal(0.0003, vol, n), -0.1, 0.1)
+    suspend = rng.random(n) < suspend_rate
+    ret[suspend] = 0
+    close = np.maximum(np.round(10*np.cumprod(1+ret), 2), 0.01)
+    prev = np.concatenate((close[:1], close[:-1]))
+    chg = np.round(close-prev, 2)
+    spread = np.abs(rng.normal(0, vol/2, n))*close
+    open_ = np.round(prev+(close-prev)*rng.random(n), 2)
+    high = np.where(suspend, close, np.round(np.maximum(open_, close)+spread, 2))
+    low = np.where(suspend, close, np.maximum(np.round(np.minimum(open_, close)-spread, 2), 0.01))
+    open_ = np.where(suspend, close, open_)
+    volume = np.where(suspend, 0, rng.integers(100000, 10000000, n))
+    df = pd.DataFrame({'date_time': dates, 'symbol': sym, 'name': name, 'open': open_, 'low': low,
+                       'high': high, 'close': close, 'chg': chg, 'pct_chg': np.round(chg/prev*100, 4),
+                       'volume': volume, 'turnover': np.round(volume*close, 2), 'suspend': suspend})
+    df.to_csv(os.path.join(sym_path, '%s.csv'%sym), encoding='gbk')
+
+def make_universe(path, n_symbols, n_years=15, start_date='2005-01-04', seed=0):
+    """
+    在path/database/sym_data下生成n_symbols只股票及基准指数n_years年的合成行情数据
+    约1/3的股票在回测期间上市（前半段随机日期），返回(代码列表, 交易日序列)
+    """
+    sym_path = os.path.join(path, 'database', 'sym_data')
+    os.makedirs(sym_path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(start_date, periods=n_years*TRADE_DAYS).strftime('%Y-%m-%d').to_numpy()
+    write_symbol(sym_path, BENCHMARK, '基准指数', dates, rng, vol=0.015, suspend_rate=0)
+    symbols = ['%06d.SZ'%k for k in range(1, n_symbols+1)]
+    for sym in symbols:
+        start = int(rng.integers(0, len(dates)//2)) if rng.random() < 1/3 else 0
+        write_symbol(sym_path, sym, 'S'+sym[:6], dates[start:], rng)
+    return symbols, dates
+
+def rebalance_weights(symbols, dates):
+    """
+    调仓策略的目标权重：每REBALANCE_DAYS个交易日等权调仓一次，其余交易日不调整
+    """
+    n = len(symbols)
+    return pd.DataFrame(0.99/n, index=dates[::REBALANCE_DAYS], columns=symbols)
+
+def get_peak_memory():
+    """
+    当前进程的内存峰值（MB），不支持时返回None
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024.**2 if sys.platform == 'darwin' else peak/1024. # macOS单位为字节，Linux为KB
+
+def build_universe_cache(path):
+    """
+    在path下生成全部行情数据的二进制缓存，返回耗时
+    """
+    os.chdir(path)
+    t = time.perf_counter()
+    cache.build_cache()
+    return time.perf_counter()-t
+
+def make_context(symbols, dates):
+    """
+    合成股票池的回测参数：全部代码、全部日期
+    """
+    return backtest.ContextInfo({'symbol_list': list(symbols), 'benchmark': BENCHMARK,
+                                 'start_date': dates[0], 'end_date': dates[-1],
+                                 'initial_capital': 10000000, 'commission_rate': 0.0003,
+                                 'min_commission': 5})
+
+def check_engines(path, symbols, dates):
+    """
+    在path下以调仓策略的目标权重校验事件驱动回测与向量化回测的结果（见vectorized.compare_engines）
+    一致时返回'ok'，否则返回不一致的原因
+    """
+    os.chdir(path)
+    try:
+        vectorized.compare_engines(make_context(symbols, dates), rebalance_weights(symbols, dates))
+    except AssertionError as e:
+        return 'mismatch: %s'%e
+    return 'ok'
+
+def run_case(path, name, symbols, dates):
+    """
+    在path下运行单个回测用例，返回各阶段耗时、事件数及内存峰值
+    name：sma（SimpleMovingAverage）、rsrs（RSRS）、rebalance（TargetWeight定期等权调仓）、
+    vectorized（与rebalance相同的目标权重，使用vectorized.VectorizedBacktest）
+    独立进程运行时，vectorized的loop包含首次调用撮合函数时numba的编译（或读取编译缓存）耗时
+    """
+    os.chdir(path)
+    ContextInfo = make_context(symbols, dates)
+    if name == 'vectorized':
+        bt = vectorized.VectorizedBacktest(ContextInfo, rebalance_weights(symbols, dates))
+    elif name == 'rebalance':
+        ContextInfo.params = {'weights': rebalance_weights(symbols, dates)}
+        bt = backtest.backtest(ContextInfo, strategy.TargetWeight)
+    elif name == 'sma':
+        bt = backtest.backtest(ContextInfo, strategy.SimpleMovingAverage)
+    elif name == 'rsrs':
+        bt = backtest.backtest(ContextInfo, strategy.RSRS)
+    else:
+        raise ValueError("unknown benchmark case: %s"%name)
+    bt.run()
+    t = time.perf_counter()
+    report = analysis.PerformanceReport(bt.portfolios, BENCHMARK)
+    timings = dict(bt.timings, analysis=time.perf_counter()-t)
+
+    # 事件数：每根K线1个MARKET，每笔委托1个ORDER，每笔成交1个FILL（向量化回测按同样口径折算）
+    broker = getattr(bt, 'broker', bt)
+    n_bars = bt.portfolios.n_records
+    n_fills = len(broker.execution_records)
+    n_orders = n_fills+sum(broker.rejections.counts.values())
+    n_events = n_bars+n_orders+n_fills
+    return {'case': name, 'timings': timings, 'total': sum(timings.values()),
+            'bars': n_bars, 'orders': n_orders, 'fills': n_fills, 'events': n_events,
+            'events_per_sec': n_events/timings['loop'] if timings['loop'] > 0 else None,
+            'peak_memory_mb': get_peak_memory(),
+            'final_networth': float(report.networth[-1]) if len(report.networth) else None}
+
+def call(isolate, fn, *args):
+    """
+    isolate为True时在新进程（spawn）中执行，内存峰值只统计该次调用
+    """
+    if not isolate:
+        cwd = os.getcwd()
+        try:
+            return fn(*args)
+        finally:
+            os.chdir(cwd)
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(fn, *args).result()
+
+def get_environment():
+    """
+    运行环境及代码版本，用于不同版本的结果比较
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'numba': numba_version}
+
+def run_suite(n_symbols=(10, 300), n_years=15, cases=CASES, isolate=True, keep=False, dispatch=True, check=False):
+    """
+    运行基准测试，返回结果字典（可直接序列化为JSON）
+    n_symbols为各合成股票池的股票数量，每个股票池生成在独立的临时目录中，keep为False时测试后删除
+    各股票池先生成二进制缓存（cache_build），因此各用例的load均为读取缓存的耗时
+    isolate为True时每个用例在独立进程中运行，peak_memory_mb为该用例的内存峰值；否则为当前进程的累计峰值
+    dispatch为True时同时运行事件分发微基准（bench_event_dispatch）
+    check为True时校验各股票池上事件驱动与向量化回测的结果一致，结果记录在engine_check中
+    """
+    result = {'environment': get_environment(), 'n_years': n_years, 'universes': []}
+    for n in n_symbols:
+        path = tempfile.mkdtemp(prefix='zqbt_bench_')
+        try:
+            t = time.perf_counter()
+            symbols, dates = make_universe(path, n, n_years)
+            universe = {'n_symbols': n, 'n_days': len(dates), 'path': path,
+                        'generate': time.perf_counter()-t,
+                        'cache_build': call(isolate, build_universe_cache, path), 'cases': []}
+            for name in cases:
+                universe['cases'].append(call(isolate, run_case, path, name, symbols, dates))
+            if check:
+                universe['engine_check'] = call(isolate, check_engines, path, symbols, dates)
+        finally:
+            if not keep:
+                shutil.rmtree(path, ignore_errors=True)
+        result['universes'].append(universe)
+    if dispatch:
+        result['event_dispatch'] = bench_event_dispatch()
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='zqbt benchmark suite')
+    parser.add_argument('--symbols', type=int, nargs='+', default=[10, 300], help='合成股票池的股票数量')
+    parser.add_argument('--years', type=int, default=15, help='合成数据的年数')
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=CASES, help='回测用例')
+    parser.add_argument('--output', help='JSON结果文件，为空时输出到控制台')
+    parser.add_argument('--in-process', action='store_true', help='在当前进程中运行全部用例')
+    parser.add_argument('--keep', action='store_true', help='保留生成的合成数据')
+    parser.add_argument('--no-dispatch', action='store_true', help='不运行事件分发微基准')
+    parser.add_argument('--check', action='store_true', help='校验事件驱动与向量化回测的结果一致')
+    args = parser.parse_args()
+
+    result = run_suite(args.symbols, args.years, args.cases, isolate=not args.in_process,
+                       keep=args.keep, dispatch=not args.no_dispatch, check=args.check)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    print(text)
+    if any(u.get('engine_check', 'ok') != 'ok' for u in result['universes']):
+        sys.exit('engine check failed')
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
 from abc import ABCMeta, abstractmethod
+import numpy as np
 import pandas as pd
 
 from event import FillEvent
-import datetime
+import matching
+from log import get_logger, RejectCode, RejectionLog
 import math
 
+logger = get_logger('broker')
+
 class ExecutionHandler(object, metaclass=ABCMeta):
     """
     ExecutionHandler抽象类处理由Portfolio生成的order对象
@@ -38,19 +42,30 @@ class SimulatedExecution(ExecutionHandler):
         #self.execution_records = pd.DataFrame(
         #    columns=['date_time','symbol','order_price','order_amount','commission'])
         self.execution_records = []
+        # 委托拒绝记录，以RejectCode记录拒绝原因
+        self.rejections = RejectionLog()
+        # 已撮合但Portfolio尚未处理成交回报的现金及持仓变动，叠加在Portfolio的实时持仓上判断是否可用
+        # 在每根K线的第一笔委托时创建，K线切换后丢弃，无委托的K线不产生任何开销
+        self.pending = None
+        self.pending_index = -1 # pending所属K线的行号
+        self.orders = [] # 批量撮合模式下当前K线缓存的委托（见buffer_order）
+
+    def get_pending(self):
+        """
+        获取当前K线的待回报变动，进入新的K线时丢弃上一根K线的记录
+        """
+        if self.pending_index != self.bars.bar_index:
+            self.pending = {'cash': 0.}
+            self.pending_index = self.bars.bar_index
+        return self.pending
 
-    def update_temp_pos(self):
+    def update_fill(self, event):
         """
-        做一个临时的持仓表，以判断现金和持仓是否充足可用（实盘由交易所判断）
-        在Portfolio处理完FILL事件后，重新获取temp_pos
+        接收Fill事件：成交已计入Portfolio，从待回报变动中扣除，避免重复计算
         """
-        #print(self.portfolio.positions)
-        self.temp_pos = {}
-        self.temp_pos['cash'] = self.portfolio.positions['cash']
-        for sym in self.portfolio.symbol_list:
-            self.temp_pos[sym] = self.portfolio.positions[sym]
-        #print(self.temp_pos)
-        #print(len(self.temp_pos))
+        if self.pending_index == self.bars.bar_index:
+            self.pending['cash'] += event.order_price*event.order_amount+event.commission
+            self.pending[event.symbol] -= event.order_amount
 
     def execute_order(self, event):
         """
@@ -60,22 +75,26 @@ class SimulatedExecution(ExecutionHandler):
         order_amount = event.order_amount
         order_price = event.order_price
 
-        cur_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        bar_date = self.bars.get_latest_bar(symbol)['date_time']
-        last_close = self.bars.get_latest_bar(symbol)['close']
+        bar = self.bars.get_latest_bar(symbol)
+        bar_date = bar['date_time']
+        last_close = bar['close']
 
         # 判断是否停牌
         if self.bars.is_suspended_stock(symbol):
-            print("[%s][股票当日停牌]Time：%s，Symbol：%s，Stock Suspended！"%(cur_date,bar_date,symbol))
+            self.rejections.append(bar_date,symbol,RejectCode.SUSPENDED,order_price,order_amount)
+            logger.debug("[股票当日停牌]Time：%s，Symbol：%s，Stock Suspended！",bar_date,symbol)
             return
 
         # 判断是否涨/跌停（注意：未考虑创业/科创板的20%涨跌停及ST股的5%涨跌停）
         # 如果涨停买入或跌停卖出，则委托无效，不进行撮合
-        if self.bars.get_latest_bar(symbol)['pct_chg'] >= 9.98 and order_amount > 0:
-            print("[%s][股票当日涨停]Time：%s，Symbol：%s，Trade Limited！"%(cur_date,bar_date,symbol))
+        pct_chg = bar['pct_chg']
+        if pct_chg >= 9.98 and order_amount > 0:
+            self.rejections.append(bar_date,symbol,RejectCode.LIMIT_UP,order_price,order_amount)
+            logger.debug("[股票当日涨停]Time：%s，Symbol：%s，Trade Limited！",bar_date,symbol)
             return
-        if self.bars.get_latest_bar(symbol)['pct_chg'] <= -9.98 and order_amount < 0:
-            print("[%s][股票当日跌停]Time：%s，Symbol：%s，Trade Limited！"%(cur_date,bar_date,symbol))
+        if pct_chg <= -9.98 and order_amount < 0:
+            self.rejections.append(bar_date,symbol,RejectCode.LIMIT_DOWN,order_price,order_amount)
+            logger.debug("[股票当日跌停]Time：%s，Symbol：%s，Trade Limited！",bar_date,symbol)
             return
 
         # 市价单：委托价为收盘价
@@ -91,38 +110,37 @@ class SimulatedExecution(ExecutionHandler):
         # 处理order_amount，向下取整百（需要用floor处理负数）
         order_amount = math.floor(order_amount/100)*100
         if order_amount == 0: # 委托数量为0，则中止运行
-            print("[%s][委托数量错误]Time：%s，Symbol：%s，Price：%s，Qty：%s，Quantity Error！"%(cur_date,bar_date,symbol,order_price,order_amount))
+            self.rejections.append(bar_date,symbol,RejectCode.QUANTITY,order_price,order_amount)
+            logger.debug("[委托数量错误]Time：%s，Symbol：%s，Price：%s，Qty：%s，Quantity Error！",bar_date,symbol,order_price,order_amount)
             return
 
         # 计算手续费=MAX（交易额*佣金率，最低手续费）
-        commission = max(round(order_price*abs(order_amount)*self.commission_rate,2),self.min_commission)
+        # Bar字段为np.float64，转换为float以使用Python的round（np.float64的round按x*100取整，结果可能相差0.01元）
+        commission = max(round(float(order_price)*abs(order_amount)*self.commission_rate,2),self.min_commission)
 
-        # 判断现金及持仓是否可用
+        # 判断现金及持仓是否可用：Portfolio实时持仓+待回报变动（实盘由交易所判断）
+        pending = self.get_pending()
         if order_amount > 0: # 若买入，判断可用资金（暂不考虑手续费，现金可能出现负数）
-            #if order_amount*order_price+commission > self.temp_pos['cash']:
-            if order_amount*order_price > self.temp_pos['cash']:
+            if order_amount*order_price > self.portfolio.get_cash()+pending['cash']:
                 # 可用资金不足，不执行买入
-                print("[%s][可用资金不足]Time：%s，Symbol：%s，Price：%s，Qty：%s，Cash Error！"%(cur_date,bar_date,symbol,order_price,order_amount))
+                self.rejections.append(bar_date,symbol,RejectCode.CASH,order_price,order_amount)
+                logger.debug("[可用资金不足]Time：%s，Symbol：%s，Price：%s，Qty：%s，Cash Error！",bar_date,symbol,order_price,order_amount)
                 return
         elif order_amount < 0: # 若卖出，判断可用数量
-            if order_amount < -self.temp_pos[symbol]:
+            if order_amount < -(self.portfolio.get_position(symbol)+pending.get(symbol, 0)):
                 # 可用数量不足，拒绝执行卖出
-                print("[%s][可用持仓不足]Time：%s，Symbol：%s，Price：%s，Qty：%s，Position Error！"%(cur_date,bar_date,symbol,order_price,order_amount))
+                self.rejections.append(bar_date,symbol,RejectCode.POSITION,order_price,order_amount)
+                logger.debug("[可用持仓不足]Time：%s，Symbol：%s，Price：%s，Qty：%s，Position Error！",bar_date,symbol,order_price,order_amount)
                 return
 
         # 交易撮合，生成FILL事件
         fill_event = FillEvent(symbol,order_amount,order_price,commission)
         self.events.put(fill_event)
-        print("[%s][委托交易成功]Time：%s，Symbol：%s，Price：%s，Qty：%s"%(cur_date,bar_date,symbol,order_price,order_amount))
+        logger.debug("[委托交易成功]Time：%s，Symbol：%s，Price：%s，Qty：%s",bar_date,symbol,order_price,order_amount)
 
-        # 实时更新至temp_pos，以便验证每个订单的持仓及金额是否可用
-        # 此处遇到问题：如果直接令temp_pos=portfolio.positions，
-        # 当temp_pos变动时，portfolio也会发生变动，
-        # 而新建一个temp_pos字典可以解决这个问题，具体原因不明
-        # print(self.portfolio.positions)
-        self.temp_pos['cash'] -= order_price*order_amount+commission
-        self.temp_pos[symbol] += order_amount
-        # print(self.portfolio.positions)
+        # 记入待回报变动，Portfolio处理成交回报前的后续委托以此判断持仓及资金是否可用
+        pending['cash'] -= order_price*order_amount+commission
+        pending[symbol] = pending.get(symbol, 0)+order_amount
 
         # 写入交易记录
         record = {}
@@ -134,9 +152,71 @@ class SimulatedExecution(ExecutionHandler):
         #self.execution_records = self.execution_records.append(record, ignore_index=True)
         self.execution_records.append(record)
 
+    def execute_batch(self, cols, qty, price=None):
+        """
+        批量撮合当前K线的一批委托（见matching.match_orders），按输入顺序判断，规则与execute_order一致
+        cols为委托代码在symbol_list中的列号，qty为委托数量，price为委托价格（NaN或None为市价单）
+        如需与事件分发的处理顺序一致，卖出委托应排在买入委托之前
+        """
+        i = self.bars.bar_index
+        panel = self.bars.panel
+        symbol_list = self.portfolio.symbol_list
+        if price is None:
+            price = np.full(len(cols), np.nan)
+
+        # 可用持仓及资金：Portfolio实时持仓+待回报变动
+        pending = self.get_pending()
+        positions = self.portfolio.positions.copy()
+        for sym, delta in pending.items():
+            if sym != 'cash':
+                positions[self.portfolio.symbol_index[sym]] += delta
+        amount, fill_price, commission, code = matching.match_orders(
+            cols, qty, price, panel.fields['close'][i], panel.fields['pct_chg'][i], panel.suspended[i],
+            positions, self.portfolio.get_cash()+pending['cash'], self.commission_rate, self.min_commission)
+
+        bar_date = panel.dates[i]
+        for k in range(len(code)):
+            symbol = symbol_list[cols[k]]
+            if code[k] != 0:
+                # 停牌及涨跌停在取整前拒绝，记录原委托数量
+                order_amount = qty[k] if code[k] <= RejectCode.LIMIT_DOWN else amount[k]
+                self.rejections.append(bar_date,symbol,RejectCode(code[k]),fill_price[k],order_amount)
+                logger.debug("[委托拒绝]Time：%s，Symbol：%s，Price：%s，Qty：%s，Reason：%s",
+                             bar_date,symbol,fill_price[k],order_amount,RejectCode(code[k]).name)
+                continue
+            self.events.put(FillEvent(symbol,amount[k],fill_price[k],commission[k]))
+            logger.debug("[委托交易成功]Time：%s，Symbol：%s，Price：%s，Qty：%s",bar_date,symbol,fill_price[k],amount[k])
+            pending['cash'] -= fill_price[k]*amount[k]+commission[k]
+            pending[symbol] = pending.get(symbol, 0)+amount[k]
+            self.execution_records.append({'date_time': bar_date, 'symbol': symbol, 'order_price': fill_price[k],
+                                           'order_amount': amount[k], 'commission': commission[k]})
+
+    def buffer_order(self, event):
+        """
+        批量撮合模式：接收Order事件时只缓存委托，当前K线的事件处理完毕后由flush_orders统一撮合
+        """
+        self.orders.append(event)
+
+    def flush_orders(self):
+        """
+        先卖后买批量撮合当前K线缓存的全部委托（见execute_batch），同一方向按委托顺序，与PriorityEventBus的处理顺序一致
+        成交回报写入事件队列，返回是否有委托
+        """
+        if not self.orders:
+            return False
+        orders = sorted(self.orders, key=lambda e: e.order_amount >= 0)
+        self.orders = []
+        symbol_index = self.portfolio.symbol_index
+        cols = np.array([symbol_index[e.symbol] for e in orders], dtype=np.int64)
+        qty = np.array([e.order_amount for e in orders], dtype=np.float64)
+        price = np.array([np.nan if e.order_price == 'MARKET' else e.order_price for e in orders], dtype=np.float64)
+        self.execute_batch(cols, qty, price)
+        return True
+
     def download_records(self):
         """
         导出交易记录
         """
         execution_records = pd.DataFrame(self.execution_records)
-        execution_records.to_csv('logs/execution_records.csv')
\ No newline at end of file
+        execution_records.to_csv('logs/execution_records.csv')
+        self.rejections.download('logs/rejection_records.csv')
\ No newline at end of file
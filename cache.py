@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""
+行情数据的二进制缓存，不涉及具体的事件循环
+将sym_data中的CSV文件按字段转换为.npy文件，每只股票一个目录
+读取时通过内存映射（mmap）打开，避免每次回测重复解析GBK编码的CSV
+缓存以源文件的修改时间及哈希值为键，源文件变化后自动重建；缓存不可用时回退为读取CSV
+"""
+
+import io
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from log import get_logger
+
+logger = get_logger('cache')
+
+SYM_DATA_PATH = 'database/sym_data' # 行情CSV文件路径
+CACHE_PATH = 'database/sym_cache' # 二进制缓存路径
+CACHE_VERSION = 1 # 缓存格式版本，格式变化时递增以使旧缓存失效
+
+def get_file_hash(file_name):
+    """
+    计算文件的SHA1哈希值
+    """
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def read_csv_arrays(file_name):
+    """
+    读取CSV文件并转换为列式数组，每个字段对应一个连续数组
+    数值字段保持float64/int64/bool类型，文本字段转换为定长字符串数组（可内存映射）
+    """
+    df = pd.read_csv(file_name, encoding="gbk", index_col=False)
+    arrays = {}
+    for col in df.columns:
+        if col.startswith('Unnamed'): # 跳过CSV中的行索引列
+            continue
+        if df[col].dtype.kind in 'biuf':
+            arrays[col] = np.ascontiguousarray(df[col].to_numpy())
+        else:
+            arrays[col] = df[col].astype(str).to_numpy().astype(str)
+    return arrays
+
+def write_json(file_name, obj):
+    """
+    写入JSON文件，先写临时文件再替换，避免中断时留下不完整的文件
+    """
+    with open(file_name+'.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(file_name+'.tmp', file_name)
+
+def get_cache_dir(sym):
+    return os.path.join(CACHE_PATH, sym)
+
+def read_manifest(sym):
+    """
+    读取缓存清单，清单不存在或格式不符时返回None
+    """
+    try:
+        with open(os.path.join(get_cache_dir(sym), 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != CACHE_VERSION:
+        return None
+    return manifest
+
+def write_manifest(sym, manifest):
+    write_json(os.path.join(get_cache_dir(sym), 'manifest.json'), manifest)
+
+def write_cache(sym, arrays, stat, file_hash):
+    """
+    将列式数组写入缓存目录，每个字段一个.npy文件，最后写入清单
+    """
+    cache_dir = get_cache_dir(sym)
+    os.makedirs(cache_dir, exist_ok=True)
+    for field, arr in arrays.items():
+        np.save(os.path.join(cache_dir, '%s.npy'%field), arr)
+    write_manifest(sym, {'version': CACHE_VERSION,
+                         'mtime_ns': stat.st_mtime_ns,
+                         'size': stat.st_size,
+                         'sha1': file_hash,
+                         'fields': list(arrays.keys())})
+
+def read_cache(sym, manifest):
+    """
+    以只读内存映射方式打开缓存中的全部字段
+    """
+    cache_dir = get_cache_dir(sym)
+    return {field: np.load(os.path.join(cache_dir, '%s.npy'%field), mmap_mode='r')
+            for field in manifest['fields']}
+
+def append_npy(file_name, arr):
+    """
+    在.npy文件末尾追加数据：文件头长度不变时原地改写数组长度并追加，否则整体重写
+    """
+    with open(file_name, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        header = io.BytesIO()
+        d = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+             'shape': (shape[0]+len(arr),)}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, d)
+        else:
+            np.lib.format.write_array_header_2_0(header, d)
+        if len(shape) == 1 and not fortran_order and len(header.getvalue()) == offset:
+            f.seek(0)
+            f.write(header.getvalue())
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+            return
+    old = np.load(file_name)
+    np.save(file_name, np.concatenate((old, arr.astype(old.dtype))))
+
+def append_cache(sym, arrays, stat):
+    """
+    将源CSV文件新追加的行（列式数组）追加到已有缓存，避免重新解析整个CSV，stat为追加后源文件的状态
+    缓存不存在、字段或类型不一致时不做处理，由load_symbol在下次读取时重建；返回是否追加成功
+    追加后不计算源文件的哈希值（清单中为None）
+    """
+    manifest = read_manifest(sym)
+    if manifest is None or set(manifest['fields']) != set(arrays):
+        return False
+    cache_dir = get_cache_dir(sym)
+    try:
+        # 先检查全部字段的类型，避免只追加了部分字段
+        converted = {}
+        for field in manifest['fields']:
+            old = np.load(os.path.join(cache_dir, '%s.npy'%field), mmap_mode='r')
+            new = arrays[field]
+            if old.dtype.kind == 'U' and new.dtype.kind == 'U':
+                converted[field] = new # 新数据的字符串更长时，append_npy整体重写
+            elif old.dtype.kind in 'biuf' and new.dtype.kind in 'biuf' and \
+                    np.can_cast(new.dtype, old.dtype, 'same_kind'):
+                converted[field] = new.astype(old.dtype)
+            else:
+                return False
+            del old
+        for field in manifest['fields']:
+            arr = converted[field]
+            file_name = os.path.join(cache_dir, '%s.npy'%field)
+            if arr.dtype.kind == 'U' and arr.dtype.itemsize > np.load(file_name, mmap_mode='r').dtype.itemsize:
+                old = np.load(file_name)
+                np.save(file_name, np.concatenate((old, arr)))
+            else:
+                append_npy(file_name, arr)
+    except (OSError, ValueError):
+        return False
+    manifest.update({'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': None})
+    write_manifest(sym, manifest)
+    return True
+
+def load_symbol(sym, use_cache=True):
+    """
+    获取单只股票的列式数组，优先读取缓存，缓存失效时读取CSV并重建缓存
+    源文件不存在时抛出OSError
+    """
+    file_name = os.path.join(SYM_DATA_PATH, '%s.csv'%sym)
+    stat = os.stat(file_name)
+    if not use_cache:
+        return read_csv_arrays(file_name)
+
+    file_hash = None
+    manifest = read_manifest(sym)
+    if manifest is not None:
+        try:
+            # 修改时间及大小未变化，直接使用缓存
+            if manifest['mtime_ns'] == stat.st_mtime_ns and manifest['size'] == stat.st_size:
+                return read_cache(sym, manifest)
+            # 修改时间变化但内容未变化（如重新复制文件），更新清单后使用缓存
+            file_hash = get_file_hash(file_name)
+            if manifest['sha1'] == file_hash:
+                arrays = read_cache(sym, manifest)
+                manifest['mtime_ns'] = stat.st_mtime_ns
+                manifest['size'] = stat.st_size
+                write_manifest(sym, manifest)
+                return arrays
+        except (OSError, ValueError, KeyError): # 缓存损坏，重新读取CSV
+            pass
+
+    arrays = read_csv_arrays(file_name)
+    try:
+        if file_hash is None:
+            file_hash = get_file_hash(file_name)
+        write_cache(sym, arrays, stat, file_hash)
+    except OSError: # 缓存目录不可写时，仅使用CSV数据
+        logger.warning("%s cache is not writable, using CSV data",sym)
+    return arrays
+
+def build_cache(sym_list=None):
+    """
+    将sym_data中的CSV文件批量转换为二进制缓存，已是最新的缓存不会重建
+    返回转换失败的代码列表
+    """
+    if sym_list is None:
+        sym_list = [fn[:-4] for fn in os.listdir(SYM_DATA_PATH) if fn.endswith('.csv')]
+    li_failed = []
+    for sym in sym_list:
+        try:
+            load_symbol(sym)
+        except Exception:
+            li_failed.append(sym)
+    return li_failed
+
+if __name__ == '__main__':
+    li_failed = build_cache()
+    print('=====缓存转换完成=====')
+    print('转换失败：',li_failed)
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
 from abc import ABCMeta, abstractmethod
+from multiprocessing import shared_memory
+import numpy as np
 import pandas as pd
 
 from event import MarketEvent
+from log import get_logger
+import cache
+
+logger = get_logger('data')
 
 class DataHandler(object):
     """
@@ -27,6 +33,20 @@ class DataHandler(object):
         """
         raise NotImplementedError("Should implement get_latest_bars()")
 
+    @abstractmethod
+    def get_latest_window(self, symbol, field, N=1):
+        """
+        返回单个字段最近的N条数据
+        """
+        raise NotImplementedError("Should implement get_latest_window()")
+
+    def get_latest_windows(self, symbol, fields, N=1):
+        """
+        返回多个字段最近的N条数据，按fields顺序组成元组
+        默认逐个字段调用get_latest_window，子类可一次性获取以减少开销
+        """
+        return tuple(self.get_latest_window(symbol, field, N) for field in fields)
+
     @abstractmethod
     def update_bars(self):
         """
@@ -34,174 +54,422 @@ class DataHandler(object):
         """
         raise NotImplementedError("Should implement update_bars()")
 
+class Bar(object):
+    """
+    单根K线的轻量视图，按字段名取值，直接读取面板数据中的对应位置（不复制数据）
+    """
+
+    __slots__ = ('_panel', '_i', '_j')
+
+    def __init__(self, panel, i, j):
+        self._panel = panel
+        self._i = i
+        self._j = j
+
+    def __getitem__(self, field):
+        return self._panel.get_value(field, self._i, self._j)
+
+    def get(self, field, default=None):
+        try:
+            return self._panel.get_value(field, self._i, self._j)
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._panel.keys()
+
+    def to_dict(self):
+        """
+        转换为字典格式（会复制数据）
+        """
+        return {field: self[field] for field in self.keys()}
+
+class BarWindow(object):
+    """
+    最近N根K线的列式视图，按字段名返回数组切片（数值字段不复制数据）
+    """
+
+    __slots__ = ('_panel', '_j', '_start', '_end')
+
+    def __init__(self, panel, j, start, end):
+        self._panel = panel
+        self._j = j
+        self._start = start
+        self._end = end
+
+    def __getitem__(self, field):
+        return self._panel.get_column(field, self._j, self._start, self._end)
+
+    def __len__(self):
+        return self._end-self._start
+
+    def keys(self):
+        return self._panel.keys()
+
+    def to_frame(self):
+        """
+        转换为DataFrame格式（会复制数据）
+        """
+        return pd.DataFrame({field: self[field] for field in self.keys()})
+
+class MarketPanel(object):
+    """
+    按基准交易日历对齐的日期×代码面板数据，在加载时一次性构建
+    fields：数值字段，每个字段一个二维数组（行为日期，列为代码）
+    labels：文本字段（如name），以整数编码的二维数组及对应的取值表存储
+    listed：该日是否有该代码的行情数据（未上市或已退市为False）
+    suspended：该日是否停牌，未上市/退市/缺失数据的日期也视为停牌
+    未上市期间价量填充为0；上市后缺失数据的日期按前收盘价填充价格，成交量等填充为0
+    """
+
+    # 缺失数据时以前收盘价填充的价格字段
+    price_fields = ('open', 'low', 'high', 'close')
+
+    def __init__(self, dates, symbols, fields, labels, listed, suspended):
+        self.dates = dates
+        self.symbols = list(symbols)
+        self.symbol_index = {sym: j for j, sym in enumerate(self.symbols)}
+        self.fields = fields
+        self.labels = labels
+        self.listed = listed
+        self.suspended = suspended
+
+    @classmethod
+    def from_arrays(cls, symbol_arrays, calendar):
+        """
+        将每只股票的列式数组（见cache.load_symbol）按交易日历calendar对齐为面板数据
+        symbol_arrays为有序的{代码:{字段:数组}}，列顺序与其一致
+        """
+        symbols = list(symbol_arrays.keys())
+        n_dates, n_syms = len(calendar), len(symbols)
+
+        # 汇总全部字段，数值字段与文本字段分开存储
+        # 数值字段的类型按全部股票统一提升（如部分股票为int、部分为float时使用float），避免截断或NaN转换为整数
+        numeric, text = {}, []
+        for arrays in symbol_arrays.values():
+            for field, arr in arrays.items():
+                if field in ('date_time', 'symbol', 'suspend'):
+                    continue
+                if arr.dtype.kind in 'biuf':
+                    numeric[field] = np.result_type(numeric[field], arr.dtype) if field in numeric else arr.dtype
+                elif field not in text:
+                    text.append(field)
+
+        fields = {field: np.zeros((n_dates, n_syms), dtype=dtype) for field, dtype in numeric.items()}
+        listed = np.zeros((n_dates, n_syms), dtype=bool)
+        suspended = np.ones((n_dates, n_syms), dtype=bool)
+        text_rows = {field: [] for field in text}
+        label_codes = {field: np.zeros((n_dates, n_syms), dtype=np.int32) for field in text}
+
+        rows_all = np.arange(n_dates)
+        for j, arrays in enumerate(symbol_arrays.values()):
+            # 将股票的日期映射到交易日历上的行号，丢弃不在交易日历上的数据
+            dates = arrays['date_time']
+            rows = np.searchsorted(calendar, dates)
+            rows[rows >= n_dates] = n_dates-1
+            match = calendar[rows] == dates
+            rows = rows[match]
+            if len(rows) == 0:
+                continue
+            listed[rows, j] = True
+            for field, arr in arrays.items():
+                if field in fields:
+                    fields[field][rows, j] = arr[match]
+            if 'suspend' in arrays:
+                suspended[rows, j] = arrays['suspend'][match]
+            else:
+                suspended[rows, j] = False
+            for field in text:
+                if field in arrays:
+                    text_rows[field].append((rows, j, arrays[field][match]))
+
+            # 上市后缺失数据的日期（停牌、退市），价格按前收盘价填充
+            last_row = np.maximum.accumulate(np.where(listed[:, j], rows_all, -1))
+            gap = (last_row >= 0) & ~listed[:, j]
+            if gap.any() and 'close' in fields:
+                last_close = fields['close'][last_row[gap], j]
+                for field in cls.price_fields:
+                    if field in fields:
+                        fields[field][gap, j] = last_close
+
+        # 文本字段编码：0号取值为未上市的填充值，与填充值相同的实际取值也编码为0
+        labels = {}
+        for field in text:
+            values = [arr for _, _, arr in text_rows[field]]
+            categories = np.unique(np.concatenate(values)) if values else np.array([], dtype=str)
+            fill = 'Unknown' if field == 'name' else ''
+            categories = np.concatenate((np.array([fill]), categories[categories != fill]))
+            order = np.argsort(categories, kind='stable')
+            lookup = categories[order]
+            for rows, j, arr in text_rows[field]:
+                label_codes[field][rows, j] = order[np.searchsorted(lookup, arr)]
+            labels[field] = (label_codes[field], categories)
+
+        panel = cls(np.asarray(calendar), symbols, fields, labels, listed, suspended)
+        panel.set_readonly()
+        return panel
+
+    def select(self, symbols, end_date=None):
+        """
+        截取面板中的部分代码及截至end_date的日期，返回新的面板
+        代码及顺序与原面板一致时只截取日期，返回的数组均为视图，不复制数据
+        """
+        end = len(self.dates) if end_date is None else np.searchsorted(self.dates, end_date, side='right')
+        if list(symbols) == self.symbols:
+            cols = slice(None)
+        else:
+            cols = [self.symbol_index[sym] for sym in symbols]
+        fields = {field: arr[:end, cols] for field, arr in self.fields.items()}
+        labels = {field: (codes[:end, cols], categories) for field, (codes, categories) in self.labels.items()}
+        panel = MarketPanel(self.dates[:end], symbols, fields, labels,
+                            self.listed[:end, cols], self.suspended[:end, cols])
+        panel.set_readonly()
+        return panel
+
+    def to_shared(self):
+        """
+        将面板数组复制到共享内存，返回可传递给子进程的描述信息及共享内存对象
+        共享内存由调用方负责释放（close及unlink）
+        """
+        blocks = []
+        def share(arr):
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            blocks.append(shm)
+            return (shm.name, arr.shape, arr.dtype.str)
+
+        handle = {'symbols': self.symbols,
+                  'dates': share(self.dates),
+                  'listed': share(self.listed),
+                  'suspended': share(self.suspended),
+                  'fields': {field: share(arr) for field, arr in self.fields.items()},
+                  'labels': {field: (share(codes), categories) for field, (codes, categories) in self.labels.items()}}
+        return handle, blocks
+
+    @classmethod
+    def from_shared(cls, handle):
+        """
+        根据to_shared()返回的描述信息，在子进程中映射共享内存构建面板，不复制数据
+        """
+        blocks = []
+        def attach(spec):
+            name, shape, dtype = spec
+            shm = shared_memory.SharedMemory(name=name)
+            blocks.append(shm)
+            return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+        fields = {field: attach(spec) for field, spec in handle['fields'].items()}
+        labels = {field: (attach(spec), categories) for field, (spec, categories) in handle['labels'].items()}
+        panel = cls(attach(handle['dates']), handle['symbols'], fields, labels,
+                    attach(handle['listed']), attach(handle['suspended']))
+        panel.shared_blocks = blocks # 保持共享内存的引用，避免被提前释放
+        panel.set_readonly()
+        return panel
+
+    def set_readonly(self):
+        """
+        面板数组设为只读，对外返回的切片视图不能修改原始数据
+        """
+        arrays = [self.dates, self.listed, self.suspended]+list(self.fields.values())
+        arrays += [codes for codes, _ in self.labels.values()]
+        for arr in arrays:
+            arr.flags.writeable = False
+
+    def keys(self):
+        return ['date_time', 'symbol']+list(self.labels.keys())+list(self.fields.keys())+['suspend']
+
+    def get_value(self, field, i, j):
+        """
+        返回第i个日期、第j个代码的字段值
+        """
+        if field in self.fields:
+            return self.fields[field][i, j]
+        elif field == 'date_time':
+            return self.dates[i]
+        elif field == 'suspend':
+            return self.suspended[i, j]
+        elif field == 'symbol':
+            return self.symbols[j]
+        elif field in self.labels:
+            codes, categories = self.labels[field]
+            return categories[codes[i, j]]
+        raise KeyError(field)
+
+    def get_column(self, field, j, start, end):
+        """
+        返回第j个代码在[start,end)日期区间的字段数组，数值字段为只读视图
+        """
+        if field in self.fields:
+            return self.fields[field][start:end, j]
+        elif field == 'date_time':
+            return self.dates[start:end]
+        elif field == 'suspend':
+            return self.suspended[start:end, j]
+        elif field == 'symbol':
+            return np.full(end-start, self.symbols[j])
+        elif field in self.labels:
+            codes, categories = self.labels[field]
+            return categories[codes[start:end, j]]
+        raise KeyError(field)
+
 class HistoricDataHandler(DataHandler):
     """
     HistoricDataHandler类用来读取请求的代码的历史行情数据
-    历史行情数据以CSV文件形式存储在磁盘上。
+    历史行情数据以CSV文件形式存储在磁盘上，读取时优先使用二进制缓存（见cache模块）
     """
 
-    def __init__(self, events, ContextInfo):
+    def __init__(self, events, ContextInfo, panel=None):
         self.events = events
         self.symbol_list = ContextInfo.symbol_list
         self.benchmark = ContextInfo.benchmark
         self.start_date = ContextInfo.start_date
         self.end_date = ContextInfo.end_date
+        self.use_cache = ContextInfo.use_cache
 
         self.continue_backtest = True
 
-        # 如果基准代码不在代码列表中，则添加至代码列表
-        if self.benchmark not in self.symbol_list:
-            self.full_list = self.symbol_list+[self.benchmark]
-        else:
-            self.full_list = self.symbol_list
+        # 数据结构由列式数组优化为按基准日历对齐的面板数据（MarketPanel）
+        # 面板的列依次为symbol_list中的代码及基准代码，行为截至end_date的基准交易日
+        # bar_index：当前K线在面板中的行号，推进一根K线只需游标+1
+        self.panel = None
+        self.bar_index = -1
+        # last_index：回测最后一根K线的行号
+        self.last_index = -1
 
-        # Dictionary形式储存数据，Key为Symbol，Value为对应的DataFrame
-        # symbol_data：回测期间的数据，起止时间为回测的start_date及end_date
-        self.symbol_data = {}
-        # symbol_start：每只股票在回测期间的最早数据日期
-        self.symbol_start = {}
-        # symbol_update：每只股票是否可以开始取数
-        self.symbol_update = {}
-        # latest_symbol_data：随着回测进行不断更新，可获取的全部数据
-        # 起始时间为对应数据的最早时间，终止时间为回测进行的当前时间
-        self.latest_symbol_data = {}
-        # 用于间断遍历获取数据的generator
-        self.data_generator = {}
-
-        self.read_csv_files() # 数据初始化
-
-    def get_bar_list(self,df):
-        """
-        定义一个方法，将从CSV文件读取的DataFrame转换为列表嵌套字典的格式
-        每个字典为一个row(bar)，代表一根K线；每个列表包含一支股票的全部K线
-        """
-        bar_list = []
-        for r in df.iterrows():
-            row = r[1]
-            bar = {'date_time':row['date_time'],'symbol':row['symbol'],'name':row['name'],
-                   'open':row['open'],'low':row['low'],'high':row['high'],'close':row['close'],
-                   'chg':row['chg'],'pct_chg':row['pct_chg'],'volume':row['volume'],
-                   'turnover':row['turnover'],'suspend':row['suspend']}
-            bar_list.append(bar)
-        return bar_list
+        if panel is None:
+            self.read_csv_files() # 数据初始化
+        else:
+            self.load_panel(panel) # 使用已加载的面板数据（如参数优化时共享的行情数据）
 
     def read_csv_files(self):
         """
-        从数据路径中打开CSV文件，转换为DataFrame
+        从数据路径中打开CSV文件（或其二进制缓存），构建面板数据
         """
-        for sym in self.full_list:
-            try: # 尝试获取数据
-                df = pd.read_csv('database/sym_data/%s.csv'%sym,encoding="gbk",index_col=False)
-            except: # 获取数据失败时
-                print("%s is not available in the historical data set"%sym)
-                if sym == self.benchmark: # 若获取基准数据失败，终止回测
-                    break
-                else: # 若获取股票数据失败，移除该股并跳出
-                    self.symbol_list.remove(sym)
-                    continue
-
-            # 根据回测起止日期，对DataFrame进行切片
-            df_bt = df[(df['date_time']>=self.start_date)&(df['date_time']<=self.end_date)]
+        # 读取基准数据，其日期序列作为面板的交易日历
+        try:
+            arrays = cache.load_symbol(self.benchmark,self.use_cache)
+        except: # 若获取基准数据失败，终止回测
+            raise ValueError("%s is not available in the historical data set"%self.benchmark)
+        calendar = arrays['date_time'][:np.searchsorted(arrays['date_time'], self.end_date, side='right')]
+        bt_start = np.searchsorted(calendar, self.start_date, side='left')
+        if bt_start >= len(calendar): # 若基准数据为空，终止回测
+            raise ValueError("%s is not available in the selected backtesting period"%self.benchmark)
 
-            # 检测数据表是否为空，若为空则表明回测期间股票还没有上市，不参与回测
-            if len(df_bt.index)==0:
-                print("%s is not available in the selected backtesting period"%sym)
-                if sym == self.benchmark: # 若基准数据为空，终止回测
-                    break
-                else: # 若股票数据为空，移除该股并跳出
-                    self.symbol_list.remove(sym)
-                    continue
+        symbol_arrays = {}
+        for sym in list(self.symbol_list):
+            if sym == self.benchmark:
+                symbol_arrays[sym] = arrays
+                continue
+            try: # 尝试获取数据
+                sym_arrays = cache.load_symbol(sym,self.use_cache)
+            except: # 获取数据失败时，移除该股并跳出
+                logger.warning("%s is not available in the historical data set",sym)
+                self.symbol_list.remove(sym)
+                continue
 
-            #self.symbol_data[sym] = df_bt.reset_index(drop=True)
-            self.symbol_data[sym] = self.get_bar_list(df_bt.reset_index(drop=True))
+            # 检测回测期间是否有数据，若没有则表明回测期间股票还没有上市，不参与回测
+            dates = sym_arrays['date_time']
+            if np.searchsorted(dates, self.end_date, side='right') <= np.searchsorted(dates, self.start_date):
+                logger.warning("%s is not available in the selected backtesting period",sym)
+                self.symbol_list.remove(sym)
+                continue
+            symbol_arrays[sym] = sym_arrays
 
-            # 获取DataFrame在回测起始日期之前的所有数据
-            df_latest = df[df['date_time']<=self.start_date]
-            #self.latest_symbol_data[sym] = df_latest.reset_index(drop=True)
-            self.latest_symbol_data[sym] = self.get_bar_list(df_latest.reset_index(drop=True))
-            # 创建generator以间断取数
-            #self.data_generator[sym] = self.symbol_data[sym].iterrows()
-            self.data_generator[sym] = iter(self.symbol_data[sym])
+        # 如果基准代码不在代码列表中，则添加至面板的最后一列
+        if self.benchmark not in self.symbol_list:
+            symbol_arrays[self.benchmark] = arrays
 
-            # 获取sym在回测期间的最早日期
-            #self.symbol_start[sym] = df_bt.iloc[0]['date_time']
-            self.symbol_start[sym] = self.symbol_data[sym][0]['date_time']
-            # 判断是否开始取数，默认设为关闭
-            self.symbol_update[sym] = False
+        self.load_panel(MarketPanel.from_arrays(symbol_arrays, calendar))
 
-    def get_next_bar(self, sym):
+    def load_panel(self, panel):
         """
-        从数据集返回新的数据条目
+        从面板数据中截取回测使用的代码及日期，并设置游标
         """
-        for bar in self.data_generator[sym]:
-            yield bar # 通过generator实现数据的间断获取
+        if self.benchmark not in panel.symbol_index:
+            raise ValueError("%s is not available in the historical data set"%self.benchmark)
+        for sym in list(self.symbol_list):
+            if sym not in panel.symbol_index: # 面板中没有该股数据，移除该股
+                logger.warning("%s is not available in the historical data set",sym)
+                self.symbol_list.remove(sym)
+
+        # 如果基准代码不在代码列表中，则添加至代码列表
+        if self.benchmark not in self.symbol_list:
+            self.full_list = self.symbol_list+[self.benchmark]
+        else:
+            self.full_list = self.symbol_list
+
+        self.panel = panel.select(self.full_list, self.end_date)
+        bt_start = np.searchsorted(self.panel.dates, self.start_date, side='left')
+        if bt_start >= len(self.panel.dates): # 若基准数据为空，终止回测
+            raise ValueError("%s is not available in the selected backtesting period"%self.benchmark)
+        self.bar_index = bt_start-1
+        self.last_index = len(self.panel.dates)-1
 
     def update_bars(self):
         """
-        将最近的数据条目放入到latest_symbol_data结构中。
+        推进游标，使最近的数据条目可以被获取
         """
-        try:
-            # 获取最新的基准数据，格式为Dictionary
-            #bar_benchmark = dict(next(self.get_next_bar(self.benchmark))[1])
-            bar_benchmark = next(self.get_next_bar(self.benchmark))
-            # 将最新的基准bar写入latest_symbol_data
-            #self.latest_symbol_data[self.benchmark] = self.latest_symbol_data[self.benchmark].append(bar_benchmark,ignore_index=True)
-            self.latest_symbol_data[self.benchmark].append(bar_benchmark)
-            datetime = bar_benchmark['date_time']
-
-            # 获取股票池数据
-            for sym in self.symbol_list:
-                # 如果当前代码为基准代码，跳过（解决基准回测重复取数问题）
-                if sym == self.benchmark:
-                    continue
-
-                # 判断sym数据起始日期是否与回测当前日期一致
-                if self.symbol_start[sym] == bar_benchmark['date_time']:
-                    self.symbol_update[sym] = True # 如果日期一致，则可以开始取数
-
-                # 如果可以取数，则获取新的bar；否则根据基准日期填充数据
-                if self.symbol_update[sym]:
-                    #bar = dict(next(self.get_next_bar(sym))[1])
-                    bar = next(self.get_next_bar(sym))
-                else:
-                    bar = {'date_time':datetime,'symbol':sym,'name':'Unknown',
-                           'open':0,'low':0,'high':0,'close':0,'chg':0,'pct_chg':0,
-                           'volume':0,'turnover':0,'suspend':True
-                    }
-                # 将最新的股票bar写入写入latest_symbol_data
-                #self.latest_symbol_data[sym] = self.latest_symbol_data[sym].append(bar,ignore_index=True)
-                self.latest_symbol_data[sym].append(bar)
-
-            self.events.put(MarketEvent()) # 写入市场事件
-        except StopIteration: # 获取不到数据，循环终止，停止回测
+        if self.bar_index >= self.last_index: # 获取不到数据，停止回测
             self.continue_backtest = False
+            return
+        self.bar_index += 1
+        self.events.put(MarketEvent()) # 写入市场事件
 
     def get_latest_bar(self, sym):
         """
         从最新的symbol_list中返回最新数据条目
         """
-        try: # 返回latest_symbol_data的最后一行
-            #return self.latest_symbol_data[sym].iloc[-1]
-            return self.latest_symbol_data[sym][-1]
+        try: # 返回游标所在位置的K线视图
+            return Bar(self.panel, self.bar_index, self.panel.symbol_index[sym])
         except KeyError:
-            print("%s is not available in the historical data set"%sym)
+            logger.warning("%s is not available in the historical data set",sym)
 
     def get_latest_bars(self, sym, N=1):
         """
         从最新的symbol_list中返回最新数据条目
         """
-        try: # 返回latest_symbol_data的倒数N行
-            #return self.latest_symbol_data[sym].iloc[-N:]
-            return pd.DataFrame(self.latest_symbol_data[sym][-N:])
+        try: # 返回游标之前N根K线的数组切片
+            end = self.bar_index+1
+            return BarWindow(self.panel, self.panel.symbol_index[sym], max(end-N, 0), end)
+        except KeyError:
+            logger.warning("%s is not available in the historical data set",sym)
+
+    def get_latest_window(self, sym, field, N=1):
+        """
+        返回单个字段最近N条数据的只读数组视图，不构建DataFrame，不复制数据
+        """
+        try:
+            end = self.bar_index+1
+            return self.panel.get_column(field, self.panel.symbol_index[sym], max(end-N, 0), end)
         except KeyError:
-            print("%s is not available in the historical data set"%sym)
+            logger.warning("%s is not available in the historical data set",sym)
+
+    def get_latest_windows(self, sym, fields, N=1):
+        """
+        返回多个字段最近N条数据的只读数组视图，按fields顺序组成元组
+        """
+        try:
+            j = self.panel.symbol_index[sym]
+            end = self.bar_index+1
+            start = max(end-N, 0)
+            return tuple(self.panel.get_column(field, j, start, end) for field in fields)
+        except KeyError:
+            logger.warning("%s is not available in the historical data set",sym)
 
     def is_suspended_stock(self, sym):
         """
-        确认股票是否为停牌状态
+        确认股票是否为停牌状态（未上市或已退市也视为停牌）
+        """
+        try: # 返回游标所在位置的停牌状态
+            return self.panel.suspended[self.bar_index, self.panel.symbol_index[sym]]
+        except KeyError:
+            logger.warning("%s is not available in the historical data set",sym)
+
+    def is_listed_stock(self, sym):
+        """
+        确认股票在当前日期是否已上市（有行情数据）
         """
-        try: # 返回latest_symbol_data的最后一行
-            #return self.latest_symbol_data[sym].iloc[-1]['suspend']
-            return self.latest_symbol_data[sym][-1]['suspend']
+        try:
+            return self.panel.listed[self.bar_index, self.panel.symbol_index[sym]]
         except KeyError:
-            print("%s is not available in the historical data set"%sym)
\ No newline at end of file
+            logger.warning("%s is not available in the historical data set",sym)
@@ -5,77 +5,316 @@
 实时行情API：http://api.money.126.net/data/feed/0600000
 历史数据：http://quotes.money.163.com/service/chddata.html?code=0600000
 财务指标：http://quotes.money.163.com/service/zycwzb_600000.html
+下载在线程池中并发执行，共用一个requests.Session（连接池），失败时按指数退避重试
+已完成的下载记录在清单中（每完成flush_every个文件及结束、中断时写入磁盘），中断后重新运行时跳过当日已下载的文件
+数据源通过Source接口实现，可替换为其他数据源或本地测试服务器
+self_test()在本地测试服务器上离线检查重试、退避及断点续传（python data_downloader.py selftest）
 """
 
-import tushare as ts
-import requests
-import time
 import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-# PART1. 获取股票代码列表
+import requests
 
-#sym_list = list(ts.get_stock_basics().index) # 全部A股
-#sym_list = list(ts.get_zz500s()['code']) # 中证500
-sym_list = list(ts.get_hs300s()['code']) # 沪深300
-#print(sym_list)
+import cache
+from log import get_logger
 
-sym_pool = []
-for sym in sym_list:
-    if sym.startswith('6'):
-        ss = sym+'.SH'
-    else:
-        ss = sym+'.SZ'
-    sym_pool.append(ss)
-print('股票数量：',len(sym_pool))
+logger = get_logger('data_downloader')
 
-# PART2. 历史数据下载
+DATABASE_PATH = 'database'
+MANIFEST_FILE = 'database/download_manifest.json' # 下载清单
 
-sym_pool.append('399300.SZ') # 添加沪深300指数
-for i,sym in enumerate(sym_pool):
-    if sym.endswith('.SZ'):
-        ss = '1'+sym[:6]
-    else:
-        ss = '0'+sym[:6]
-    url='http://quotes.money.163.com/service/chddata.html?code='+ss
-    file_name = 'database/sym_data_raw/%s.csv'%sym
-    while True:
+class Source(object):
+    """
+    数据源接口：kind为数据类型（同时是database下的保存目录，如sym_data_raw）
+    """
+
+    kinds = ()
+
+    def get_url(self, kind, sym):
+        """
+        返回下载地址
+        """
+        raise NotImplementedError("Should implement get_url()")
+
+    def check(self, kind, sym, content):
+        """
+        检查下载内容是否有效，无效时抛出ValueError
+        """
+        if not content:
+            raise ValueError("empty response")
+
+class NeteaseSource(Source):
+    """
+    网易财经：sym_data_raw为历史数据，mfi_data_raw为财务指标
+    base_url可替换为本地测试服务器的地址
+    """
+
+    kinds = ('sym_data_raw', 'mfi_data_raw')
+
+    def __init__(self, base_url='http://quotes.money.163.com'):
+        self.base_url = base_url
+
+    def get_url(self, kind, sym):
+        if kind == 'sym_data_raw':
+            # 沪市代码前加0，深市代码前加1
+            code = ('1' if sym.endswith('.SZ') else '0')+sym[:6]
+            return self.base_url+'/service/chddata.html?code='+code
+        elif kind == 'mfi_data_raw':
+            return self.base_url+'/service/zycwzb_'+sym[:6]+'.html'
+        raise ValueError("unknown data kind: %s"%kind)
+
+class Downloader(object):
+    """
+    并发下载器
+    max_workers：并发线程数（同时也是连接池大小）
+    max_retries：单个文件的最大重试次数，第k次重试前等待backoff*2**(k-1)秒（不超过max_backoff）
+    连接异常、超时、服务器错误（5xx）及限流（429）时重试，其他请求错误（4xx）直接失败
+    flush_every：下载清单每完成flush_every个文件写入一次磁盘，run()结束或中断时写入剩余记录
+    """
+
+    def __init__(self, source=None, max_workers=8, max_retries=5, backoff=1., max_backoff=30., timeout=30,
+                 flush_every=100):
+        self.source = source if source is not None else NeteaseSource()
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.flush_every = flush_every
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.lock = threading.Lock()
+        self.manifest = self.read_manifest()
+        self.unflushed = 0 # 清单中尚未写入磁盘的记录数
+
+    def read_manifest(self):
         try:
-            r = requests.get(url)
-            if r.status_code != 200:
-                print('连接失败：', sym)
-                time.sleep(1) # 连接失败则暂停1秒
-                continue
+            with open(MANIFEST_FILE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_manifest(self):
+        """
+        写入下载清单（需持有self.lock）
+        """
+        cache.write_json(MANIFEST_FILE, self.manifest)
+
+    def flush_manifest(self):
+        """
+        将尚未写入的下载记录写入磁盘（需持有self.lock）
+        """
+        if self.unflushed:
+            self.write_manifest()
+            self.unflushed = 0
+
+    def fetch(self, kind, sym):
+        """
+        下载单个文件，失败时按指数退避重试，返回文件内容
+        """
+        url = self.source.get_url(kind, sym)
+        for attempt in range(self.max_retries+1):
+            if attempt > 0:
+                time.sleep(min(self.backoff*2**(attempt-1), self.max_backoff))
+            try:
+                r = self.session.get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = '%s: %s'%(type(e).__name__, e)
             else:
-                with open(file_name,"wb") as f:
-                    f.write(r.content)
-                print('下载中：', sym)
-                time.sleep(0.01) # 间隔0.01秒
-                break
-        except:
-            print('下载异常：',sym)
-            break
-print('=====历史数据下载完成=====')
-
-# PART3. 财务指标下载
-
-for i,sym in enumerate(sym_pool):
-    ss = sym[:6]
-    url='http://quotes.money.163.com/service/zycwzb_'+ss+'.html'
-    file_name = 'database/mfi_data_raw/%s.csv'%sym
-    while True:
+                if r.status_code == 200:
+                    self.source.check(kind, sym, r.content)
+                    return r.content
+                error = 'HTTP %d'%r.status_code
+                if 400 <= r.status_code < 500 and r.status_code != 429: # 请求错误（如代码不存在），不再重试
+                    break
+            logger.debug("[下载失败]%s %s：%s，第%d次", kind, sym, error, attempt+1)
+        raise IOError(error)
+
+    def download(self, kind, sym, run_date):
+        """
+        下载单个文件并保存，返回失败原因（成功时为None）
+        """
         try:
-            r = requests.get(url)
-            if r.status_code != 200:
-                print('连接失败：', sym)
-                time.sleep(1) # 连接失败则暂停1秒
-                continue
-            else:
-                with open(file_name,"wb") as f:
-                    f.write(r.content)
-                print('下载中：', sym)
-                time.sleep(0.01) # 间隔0.01秒
-                break
-        except:
-            print('下载异常：',sym)
-            break
-print('=====财务指标下载完成=====')
\ No newline at end of file
+            content = self.fetch(kind, sym)
+            file_name = os.path.join(DATABASE_PATH, kind, '%s.csv'%sym)
+            with open(file_name+'.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(file_name+'.tmp', file_name)
+        except Exception as e:
+            return '%s: %s'%(type(e).__name__, e)
+        with self.lock:
+            self.manifest.setdefault(kind, {})[sym] = run_date
+            self.unflushed += 1
+            if self.unflushed >= self.flush_every:
+                self.flush_manifest()
+        logger.info("[下载完成]%s %s", kind, sym)
+        return None
+
+    def run(self, sym_list, kinds=None, run_date=None, force=False):
+        """
+        下载sym_list的全部数据，kinds为空时下载数据源支持的全部类型
+        run_date为本次下载的日期（默认为当天），清单中已在run_date下载的文件跳过，force为True时重新下载
+        返回(已下载列表, 跳过列表, {(类型,代码):失败原因})
+        """
+        kinds = kinds or self.source.kinds
+        run_date = run_date or time.strftime('%Y-%m-%d')
+        tasks, skipped = [], []
+        for kind in kinds:
+            os.makedirs(os.path.join(DATABASE_PATH, kind), exist_ok=True)
+            done = self.manifest.get(kind, {})
+            for sym in sym_list:
+                if not force and done.get(sym) == run_date:
+                    skipped.append((kind, sym))
+                else:
+                    tasks.append((kind, sym))
+
+        downloaded, failed = [], {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = [pool.submit(self.download, kind, sym, run_date) for kind, sym in tasks]
+                try:
+                    for (kind, sym), future in zip(tasks, futures):
+                        error = future.result()
+                        if error is None:
+                            downloaded.append((kind, sym))
+                        else:
+                            failed[(kind, sym)] = error
+                            logger.warning("%s %s download failed: %s", kind, sym, error)
+                except BaseException: # 中断时取消尚未开始的下载
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally: # 结束或中断时写入剩余的下载记录
+            with self.lock:
+                self.flush_manifest()
+        return downloaded, skipped, failed
+
+def get_sym_pool(index='hs300'):
+    """
+    通过tushare获取股票代码列表，转换为带交易所后缀的代码
+    """
+    import tushare as ts
+    if index == 'hs300':
+        sym_list = list(ts.get_hs300s()['code']) # 沪深300
+    elif index == 'zz500':
+        sym_list = list(ts.get_zz500s()['code']) # 中证500
+    else:
+        sym_list = list(ts.get_stock_basics().index) # 全部A股
+    return [sym+'.SH' if sym.startswith('6') else sym+'.SZ' for sym in sym_list]
+
+def self_test(backoff=0.1, max_backoff=0.2, max_retries=3):
+    """
+    离线自检：在临时目录中对本地测试服务器下载，服务器按代码返回预设的响应，检查
+    重试（5xx、429重试，4xx及无效内容不重试）、指数退避（两次请求的间隔在退避时间与退避时间+backoff之间，退避时间不超过max_backoff）、
+    断点续传（再次运行时跳过已下载的文件，只重新下载失败的文件，force时全部重新下载）
+    检查失败时抛出AssertionError
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    # 代码 -> 依次返回的状态码（用完后重复最后一个），状态码为200且内容为空时对应无效内容
+    responses = {'600000.SH': [200], '600001.SH': [404], '600002.SH': [503, 503, 200],
+                 '600003.SH': [429, 200], '600004.SH': [503], '600005.SH': [0]}
+    content = b'date,close\n2020-01-02,10.0\n'
+    requests_log = {} # 代码 -> 请求时间列表
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            code = self.path.rsplit('=', 1)[-1]
+            sym = code[1:]+('.SZ' if code.startswith('1') else '.SH')
+            with lock:
+                times = requests_log.setdefault(sym, [])
+                times.append(time.perf_counter())
+                script = responses[sym]
+                status = script[min(len(times), len(script))-1]
+            body = content if status == 200 else b''
+            self.send_response(200 if status == 0 else status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    lock = threading.Lock()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix='zqbt_download_')
+    try:
+        os.chdir(path)
+        source = NeteaseSource('http://127.0.0.1:%d'%server.server_port)
+        sym_list = sorted(responses)
+
+        def run(**kwargs):
+            downloader = Downloader(source, max_workers=4, max_retries=max_retries, backoff=backoff,
+                                    max_backoff=max_backoff, timeout=5, flush_every=2)
+            return downloader.run(sym_list, ['sym_data_raw'], run_date='2020-01-02', **kwargs)
+
+        # 首次下载：重试及退避
+        downloaded, skipped, failed = run()
+        ok = ['600000.SH', '600002.SH', '600003.SH']
+        assert sorted(sym for _, sym in downloaded) == ok, downloaded
+        assert not skipped, skipped
+        assert sorted(sym for _, sym in failed) == ['600001.SH', '600004.SH', '600005.SH'], failed
+        attempts = {sym: len(times) for sym, times in requests_log.items()}
+        assert attempts == {'600000.SH': 1, '600001.SH': 1, '600002.SH': 3, '600003.SH': 2,
+                            '600004.SH': max_retries+1, '600005.SH': 1}, attempts
+        for sym, times in requests_log.items():
+            for k in range(len(times)-1):
+                gap, wait = times[k+1]-times[k], min(backoff*2**k, max_backoff)
+                assert wait <= gap < wait+backoff, (sym, k, gap, wait)
+        for sym in ok:
+            with open(os.path.join(DATABASE_PATH, 'sym_data_raw', '%s.csv'%sym), 'rb') as f:
+                assert f.read() == content, sym
+        with open(MANIFEST_FILE) as f:
+            assert sorted(json.load(f)['sym_data_raw']) == ok
+
+        # 断点续传：已下载的文件跳过，失败的文件重新下载
+        requests_log.clear()
+        downloaded, skipped, failed = run()
+        assert not downloaded and sorted(sym for _, sym in skipped) == ok, (downloaded, skipped)
+        assert sorted(requests_log) == ['600001.SH', '600004.SH', '600005.SH'], sorted(requests_log)
+
+        # force：全部重新下载
+        requests_log.clear()
+        downloaded, skipped, failed = run(force=True)
+        assert not skipped and sorted(requests_log) == sym_list, (skipped, sorted(requests_log))
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(path, ignore_errors=True)
+    return True
+
+if __name__ == '__main__':
+    import log
+    if len(sys.argv) > 1 and sys.argv[1] == 'selftest':
+        log.set_level('ERROR')
+        self_test()
+        print('=====下载器自检通过=====')
+        sys.exit()
+    log.set_level('INFO')
+
+    # PART1. 获取股票代码列表
+    sym_pool = get_sym_pool('hs300')
+    print('股票数量：',len(sym_pool))
+
+    # PART2. 历史数据及财务指标下载
+    downloader = Downloader()
+    downloaded, skipped, failed = downloader.run(sym_pool+['399300.SZ'], ['sym_data_raw']) # 添加沪深300指数
+    print('=====历史数据下载完成=====')
+    print('下载：%d，跳过：%d，失败：%s'%(len(downloaded), len(skipped), failed))
+    downloaded, skipped, failed = downloader.run(sym_pool, ['mfi_data_raw'])
+    print('=====财务指标下载完成=====')
+    print('下载：%d，跳过：%d，失败：%s'%(len(downloaded), len(skipped), failed))
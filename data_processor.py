@@ -2,131 +2,301 @@
 
 """
 处理网易财经爬取的原始数据，不涉及回测框架
+sym_data_raw -> sym_data（历史行情），mfi_data_raw -> mfi_data（财务指标）
+各股票在进程池中并行处理；增量模式下，原始文件的修改时间或哈希值未变化时跳过
+处理记录保存在输出目录的manifest.json中，处理失败的股票逐一返回失败原因
+日常更新可使用append()，只追加已处理数据最后日期之后的新数据，并同步追加二进制缓存
 """
 
-import pandas as pd
+import io
 import os
-import re
-
-# 处理原始历史数据
-# 注意：399300.SZ的市值、换手率字段不存在，需要另外填充
-li_all_sym = os.listdir('database/sym_data_raw')
-
-# 只处理未创建的数据
-#li_exist_sym = os.listdir('sym_data')
-#for sym in li_all_sym:
-#    if sym in li_exist_sym:
-#        li_all_sym.remove(sym)
-
-li_failed = []
-for fn in li_all_sym:
-    sym = re.split('.csv', fn)[0]
-    print('处理中：',sym)
+import sys
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import cache
+from cache import get_file_hash
+from log import get_logger
+
+logger = get_logger('data_processor')
+
+SYM_RAW_PATH = 'database/sym_data_raw' # 原始历史数据
+SYM_DATA_PATH = 'database/sym_data' # 处理后的历史数据
+MFI_RAW_PATH = 'database/mfi_data_raw' # 原始财务指标
+MFI_PATH = 'database/mfi_data' # 处理后的财务指标
+
+# 财务指标原始数据的行顺序及对应字段
+MFI_FIELDS = ['eps', # 每股收益
+              'bps', # 每股净资产
+              'cfps', # 每股净现金流
+              'income', # 主营收入
+              'main_profit', # 主营利润
+              'profit', # 营业利润
+              'inv_profit', # 投资收益
+              'other_profit', # 营业外收支
+              'total_profit', # 利润总额
+              'net_profit', # 净利润
+              'net_profit_rec', # 扣非净利润
+              'cash_flow', # 经营净现金流
+              'cash_add', # 现金增加额
+              'total_asset', # 总资产
+              'liquid_asset', # 流动资产
+              'total_liability', # 总负债
+              'liquid_liability', # 流动负债
+              'equity', # 股东权益
+              'roc'] # 净资产收益率
+
+def convert_sym_data(df, sym, last_date=None, last_close=None):
+    """
+    将原始历史数据整理为回测使用的格式，按时间正序
+    停牌日（涨跌额为None）的价格以前一交易日收盘价填充，涨跌额及涨跌幅为0
+    last_date不为空时只保留此日期之后的数据，last_close为此前最后一个交易日的收盘价（用于填充停牌日）
+    """
+    df_new = pd.DataFrame()
+    df_new['date_time'] = df['日期']
+    df_new['symbol'] = sym
+    df_new['name'] = df['名称']
+    df_new['open'] = df['开盘价']
+    df_new['low'] = df['最低价']
+    df_new['high'] = df['最高价']
+    df_new['close'] = df['收盘价']
+    df_new['chg'] = df['涨跌额']
+    df_new['pct_chg'] = df['涨跌幅']
+    df_new['turn_rate'] = df['换手率']
+    df_new['volume'] = df['成交量']
+    df_new['turnover'] = df['成交金额']
+    df_new['mkv'] = df['总市值']
+    df_new['cir_mkv'] = df['流通市值']
+    #df_new['tick_num'] = df['成交笔数'] #数据不完整
+
+    # 注意：399300.SZ的市值、换手率字段不存在，需要另外填充
+    if sym == '399300.SZ':
+        df_new['turn_rate'] = 0
+        df_new['mkv'] = 0
+        df_new['cir_mkv'] = 0
+
+    df_new = df_new.iloc[::-1].reset_index(drop=True) # 按时间正序并重置index
+    if last_date is not None:
+        df_new = df_new[df_new['date_time'].astype(str) > last_date].reset_index(drop=True)
+    return fill_suspend(df_new, last_close)
+
+def fill_suspend(df_new, last_close=None):
+    """
+    向量化填充停牌日：价格取此前最近一个非停牌日的收盘价，没有时取last_close（默认为首日收盘价）
+    """
+    # 原始数据中停牌日的涨跌额为'None'，pandas读取时默认解析为NaN，两者均视为停牌
+    suspend = (df_new['chg'].isna() | (df_new['chg'].astype(str) == 'None')).to_numpy()
+    close = pd.to_numeric(df_new['close'], errors='coerce')
+    if last_close is None and len(close) > 0:
+        last_close = close.iloc[0]
+    close = close.where(~suspend).ffill().fillna(last_close)
+
+    df_new['suspend'] = suspend
+    for field in ('open', 'low', 'high', 'close'):
+        df_new[field] = np.where(suspend, close, df_new[field])
+    df_new['chg'] = np.where(suspend, 0, df_new['chg'])
+    df_new['pct_chg'] = np.where(suspend, 0, df_new['pct_chg'])
+    return df_new
+
+def convert_mfi_data(df):
+    """
+    将原始财务指标（行为指标、列为报告期）转置为按报告期正序的数据表
+    """
+    df_t = df.T
+    dict_mfi = {'post_date': list(df_t.index[1:])}
+    for k, field in enumerate(MFI_FIELDS):
+        dict_mfi[field] = list(df_t[k])[1:]
+    return pd.DataFrame(dict_mfi).iloc[::-1].reset_index(drop=True).dropna() # 按时间正序并重置index
+
+def process_sym_data(sym):
+    df = pd.read_csv(os.path.join(SYM_RAW_PATH, '%s.csv'%sym), encoding='gbk')
+    convert_sym_data(df, sym).to_csv(os.path.join(SYM_DATA_PATH, '%s.csv'%sym), encoding='gbk')
+
+def read_last_row(file_name):
+    """
+    读取CSV文件的表头及最后一行，从文件末尾向前查找，不读取全部数据
+    """
+    with open(file_name, 'rb') as f:
+        header = f.readline()
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        buf = b''
+        while pos > len(header):
+            step = min(4096, pos-len(header))
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step)+buf
+            if buf.rstrip(b'\r\n').count(b'\n') > 0:
+                break
+    last = buf.rstrip(b'\r\n').split(b'\n')[-1]
+    header = next(csv.reader([header.decode('gbk').rstrip('\r\n')]))
+    last = next(csv.reader([last.decode('gbk').rstrip('\r')]), [])
+    return header, last
+
+def append_sym_data(sym):
+    """
+    增量更新单只股票的历史数据：只将原始数据中晚于已处理数据最后日期的行追加到sym_data，并追加二进制缓存
+    停牌日从已处理数据的最后收盘价开始向后填充；已处理数据不存在或格式不符时完整处理
+    返回追加的行数
+    """
+    out_file = os.path.join(SYM_DATA_PATH, '%s.csv'%sym)
+    df = pd.read_csv(os.path.join(SYM_RAW_PATH, '%s.csv'%sym), encoding='gbk')
+    if os.path.exists(out_file):
+        header, last = read_last_row(out_file)
+    else:
+        header, last = [], []
+    if len(last) != len(header) or len(header) < 2:
+        df_new = convert_sym_data(df, sym)
+        df_new.to_csv(out_file, encoding='gbk')
+        return len(df_new)
+
+    last = dict(zip(header, last))
+    df_new = convert_sym_data(df, sym, last['date_time'], float(last['close']))
+    if len(df_new) == 0:
+        return 0
+    if list(df_new.columns) != header[1:]:
+        raise ValueError("columns of %s do not match the processed data"%sym)
+    df_new.index = np.arange(int(last[header[0]])+1, int(last[header[0]])+1+len(df_new))
+
+    # 追加到CSV文件（不含表头），同一段文本解析为列式数组后追加到缓存
+    text = df_new.to_csv()
+    with open(out_file, 'a', encoding='gbk', newline='') as f:
+        f.write(text[text.index('\n')+1:])
+    cache.append_cache(sym, cache.read_csv_arrays(io.StringIO(text)), os.stat(out_file))
+    return len(df_new)
+
+def process_mfi_data(sym):
+    df = pd.read_csv(os.path.join(MFI_RAW_PATH, '%s.csv'%sym), encoding='gbk')
+    convert_mfi_data(df).to_csv(os.path.join(MFI_PATH, '%s.csv'%sym), encoding='gbk')
+
+# 数据类型 -> (处理函数, 原始数据路径, 输出路径)
+PIPELINES = {'sym_data': (process_sym_data, SYM_RAW_PATH, SYM_DATA_PATH),
+             'mfi_data': (process_mfi_data, MFI_RAW_PATH, MFI_PATH)}
+
+def read_manifest(path):
     try:
-        df = pd.read_csv('database/sym_data_raw/%s.csv'%sym,encoding='gbk')
-
-        # 整理到新数据表df_new
-        df_new = pd.DataFrame()
-        df_new['date_time'] = df['日期']
-        df_new['symbol'] = sym
-        df_new['name'] = df['名称']
-        df_new['open'] = df['开盘价']
-        df_new['low'] = df['最低价']
-        df_new['high'] = df['最高价']
-        df_new['close'] = df['收盘价']
-        df_new['chg'] = df['涨跌额']
-        df_new['pct_chg'] = df['涨跌幅']
-        df_new['turn_rate'] = df['换手率']
-        df_new['volume'] = df['成交量']
-        df_new['turnover'] = df['成交金额']
-        df_new['mkv'] = df['总市值']
-        df_new['cir_mkv'] = df['流通市值']
-        #df_new['tick_num'] = df['成交笔数'] #数据不完整
-
-        if sym == '399300.SZ': # 399300.SZ缺失数据填充
-            df_new['turn_rate'] = 0
-            df_new['mkv'] = 0
-            df_new['cir_mkv'] = 0
-
-        df_new = df_new.iloc[::-1].reset_index(drop=True) # 按时间正序并重置index
-
-        li_suspend = []
-        li_open = [df_new['open'][0]]
-        li_low = [df_new['low'][0]]
-        li_high = [df_new['high'][0]]
-        li_close = [df_new['close'][0]]
-        li_chg = []
-        li_pct_chg = []
-        for r in df_new.iterrows():
-            if r[1]['chg'] == 'None':
-                li_suspend.append(True)
-                li_open.append(li_close[-1])
-                li_low.append(li_close[-1])
-                li_high.append(li_close[-1])
-                li_close.append(li_close[-1])
-                li_chg.append(0)
-                li_pct_chg.append(0)
-            else:
-                li_suspend.append(False)
-                li_open.append(r[1]['open'])
-                li_low.append(r[1]['low'])
-                li_high.append(r[1]['high'])
-                li_close.append(r[1]['close'])
-                li_chg.append(r[1]['chg'])
-                li_pct_chg.append(r[1]['pct_chg'])
-
-        df_new['suspend'] = li_suspend
-        df_new['open'] = li_open[1:]
-        df_new['low'] = li_low[1:]
-        df_new['high'] = li_high[1:]
-        df_new['close'] = li_close[1:]
-        df_new['chg'] = li_chg
-        df_new['pct_chg'] = li_pct_chg
-
-        df_new.to_csv('database/sym_data/%s.csv'%sym,encoding='gbk')
-    except:
-        li_failed.append(sym)
-print('=====历史数据处理完成=====')
-print('处理失败：',li_failed)
-
-# 处理原始财务指标
-li_all_sym = os.listdir('database/mfi_data_raw')
-#li_all_sym = ['600999.SH']
-
-li_failed = []
-for fn in li_all_sym:
-    sym = re.split('.csv', fn)[0]
-    print('处理中：',sym)
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(path, manifest):
+    cache.write_json(os.path.join(path, 'manifest.json'), manifest)
+
+def _process(kind, sym):
+    """
+    子进程中处理单只股票，返回失败原因（成功时为None）
+    """
+    try:
+        PIPELINES[kind][0](sym)
+    except Exception as e:
+        return '%s: %s'%(type(e).__name__, e)
+    return None
+
+def _append(sym):
+    """
+    子进程中增量更新单只股票，返回(追加行数, 失败原因)
+    """
     try:
-        df = pd.read_csv('database/mfi_data_raw/%s.csv'%sym,encoding='gbk')
-        dict_mfi = {}
-        dict_mfi['post_date'] = list(df.T[1].index[1:])
-        dict_mfi['eps'] = list(list(df.T[0])[1:]) # 每股收益
-        dict_mfi['bps'] = list(list(df.T[1])[1:]) # 每股净资产
-        dict_mfi['cfps'] = list(list(df.T[2])[1:]) # 每股净现金流
-        dict_mfi['income'] = list(list(df.T[3])[1:]) # 主营收入
-        dict_mfi['main_profit'] = list(list(df.T[4])[1:])  # 主营利润
-        dict_mfi['profit'] = list(list(df.T[5])[1:])  # 营业利润
-        dict_mfi['inv_profit'] = list(list(df.T[6])[1:])  # 投资收益
-        dict_mfi['other_profit'] = list(list(df.T[7])[1:])  # 营业外收支
-        dict_mfi['total_profit'] = list(list(df.T[8])[1:])  # 利润总额
-        dict_mfi['net_profit'] = list(list(df.T[9])[1:])  # 净利润
-        dict_mfi['net_profit_rec'] = list(list(df.T[10])[1:])  # 扣非净利润
-        dict_mfi['cash_flow'] = list(list(df.T[11])[1:])  # 经营净现金流
-        dict_mfi['cash_add'] = list(list(df.T[12])[1:])  # 现金增加额
-        dict_mfi['total_asset'] = list(list(df.T[13])[1:])  # 总资产
-        dict_mfi['liquid_asset'] = list(list(df.T[14])[1:])  # 流动资产
-        dict_mfi['total_liability'] = list(list(df.T[15])[1:])  # 总负债
-        dict_mfi['liquid_liability'] = list(list(df.T[16])[1:])  # 流动负债
-        dict_mfi['equity'] = list(list(df.T[17])[1:])  # 股东权益
-        dict_mfi['roc'] = list(list(df.T[18])[1:])  # 净资产收益率
-
-        # 将dict导入新数据表df_mfi
-        df_mfi = pd.DataFrame(dict_mfi)
-        df_mfi = df_mfi.iloc[::-1].reset_index(drop=True).dropna()  # 按时间正序并重置index
-
-        df_mfi.to_csv('database/mfi_data/%s.csv'%sym,encoding='gbk')
-    except:
-        li_failed.append(sym)
-print('=====财务指标处理完成=====')
-print('处理失败：',li_failed)
+        return append_sym_data(sym), None
+    except Exception as e:
+        return 0, '%s: %s'%(type(e).__name__, e)
+
+def append(sym_list=None, max_workers=None):
+    """
+    增量更新历史数据（见append_sym_data），sym_list为空时更新原始数据路径下的全部股票
+    返回({代码:追加行数}, {失败代码:失败原因})
+    """
+    os.makedirs(SYM_DATA_PATH, exist_ok=True)
+    if sym_list is None:
+        sym_list = sorted(fn[:-4] for fn in os.listdir(SYM_RAW_PATH) if fn.endswith('.csv'))
+    manifest = read_manifest(SYM_DATA_PATH)
+    appended, failed = {}, {}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        results = pool.map(_append, sym_list, chunksize=max(len(sym_list)//64, 1))
+        for sym, (n, error) in zip(sym_list, results):
+            if error is None:
+                appended[sym] = n
+                # 记录原始文件状态，process()增量模式下不再重复处理
+                stat = os.stat(os.path.join(SYM_RAW_PATH, '%s.csv'%sym))
+                manifest[sym] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+            else:
+                failed[sym] = error
+                manifest.pop(sym, None)
+                logger.warning("%s appending failed: %s", sym, error)
+    write_manifest(SYM_DATA_PATH, manifest)
+    return appended, failed
+
+def process(kind='sym_data', sym_list=None, incremental=True, max_workers=None):
+    """
+    处理原始数据，kind为'sym_data'或'mfi_data'，sym_list为空时处理原始数据路径下的全部股票
+    incremental为True时跳过原始文件未变化（修改时间及大小相同，或哈希值相同）且输出文件存在的股票
+    返回(已处理代码列表, 跳过代码列表, {失败代码:失败原因})
+    """
+    _, raw_path, out_path = PIPELINES[kind]
+    os.makedirs(out_path, exist_ok=True)
+    if sym_list is None:
+        sym_list = sorted(fn[:-4] for fn in os.listdir(raw_path) if fn.endswith('.csv'))
+    manifest = read_manifest(out_path) if incremental else {}
+
+    # 对比处理记录，找出需要处理的股票
+    todo, skipped, stats = [], [], {}
+    for sym in sym_list:
+        raw_file = os.path.join(raw_path, '%s.csv'%sym)
+        try:
+            stat = os.stat(raw_file)
+        except OSError:
+            todo.append(sym) # 原始文件不存在，由处理函数报告失败
+            continue
+        record = manifest.get(sym)
+        stats[sym] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        if record is not None and os.path.exists(os.path.join(out_path, '%s.csv'%sym)):
+            if record['mtime_ns'] == stat.st_mtime_ns and record['size'] == stat.st_size:
+                skipped.append(sym)
+                continue
+            stats[sym]['sha1'] = get_file_hash(raw_file)
+            if record.get('sha1') == stats[sym]['sha1']:
+                manifest[sym].update(stats[sym])
+                skipped.append(sym)
+                continue
+        todo.append(sym)
+
+    # 并行处理
+    processed, failed = [], {}
+    if todo:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            errors = pool.map(_process, [kind]*len(todo), todo, chunksize=max(len(todo)//64, 1))
+            for sym, error in zip(todo, errors):
+                if error is None:
+                    processed.append(sym)
+                    if 'sha1' not in stats[sym]:
+                        stats[sym]['sha1'] = get_file_hash(os.path.join(raw_path, '%s.csv'%sym))
+                    manifest[sym] = stats[sym]
+                else:
+                    failed[sym] = error
+                    manifest.pop(sym, None)
+                    logger.warning("%s processing failed: %s", sym, error)
+    write_manifest(out_path, manifest)
+    return processed, skipped, failed
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['append']: # 日常更新：python data_processor.py append
+        appended, failed = append()
+        print('=====历史数据追加完成=====')
+        print('追加：%d行'%sum(appended.values()))
+        print('处理失败：', failed)
+        sys.exit()
+
+    processed, skipped, failed = process('sym_data')
+    print('=====历史数据处理完成=====')
+    print('处理：%d，跳过：%d'%(len(processed), len(skipped)))
+    print('处理失败：', failed)
+
+    processed, skipped, failed = process('mfi_data')
+    print('=====财务指标处理完成=====')
+    print('处理：%d，跳过：%d'%(len(processed), len(skipped)))
+    print('处理失败：', failed)
@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import heapq
+import itertools
+import queue
+from collections import deque
+
 class Event(object):
     """
     Event的基类，提供所有后续子类的一个接口，在后续的交易系统中会触发进一步的事件
@@ -12,6 +17,8 @@ class MarketEvent(Event):
     市场数据更新，由DataHandler对象发出，被Strategy对象接收
     """
 
+    priority = 3 # 事件优先级，数值越小越先处理（见PriorityEventBus）
+
     def __init__(self):
         self.type = 'MARKET'
 
@@ -25,15 +32,106 @@ class OrderEvent(Event):
         self.symbol = symbol
         self.order_amount = order_amount
         self.order_price = order_price
+        self.priority = 1 if order_amount < 0 else 2 # 卖出委托先于买入委托处理
 
 class FillEvent(Event):
     """
     交易结果回报，由ExecutionHandler对象发出，被Portfolio对象接收
     """
 
+    priority = 0 # 成交回报最先处理，使委托成交后立即更新持仓及现金
+
     def __init__(self, symbol, order_amount, order_price, commission):
         self.type = 'FILL'
         self.symbol = symbol
         self.order_amount = order_amount
         self.order_price = order_price
-        self.commission = commission
\ No newline at end of file
+        self.commission = commission
+
+class EventBus(object):
+    """
+    单线程事件分发器，基于collections.deque，按事件类注册处理函数
+    put()写入事件，dispatch()依次处理事件直到队列为空
+    单线程回测不需要加锁，也不使用异常控制循环
+    """
+
+    def __init__(self):
+        self.queue = deque()
+        self.handlers = {} # 事件类 -> 处理函数列表
+
+    def register(self, event_cls, handler):
+        """
+        注册事件处理函数，同一事件类可注册多个处理函数，按注册顺序调用
+        """
+        self.handlers.setdefault(event_cls, []).append(handler)
+
+    def put(self, event):
+        """
+        写入事件
+        """
+        self.queue.append(event)
+
+    def empty(self):
+        return not self.queue
+
+    def dispatch(self):
+        """
+        处理队列中的全部事件，处理过程中产生的新事件也一并处理
+        """
+        events = self.queue
+        handlers = self.handlers
+        while events:
+            event = events.popleft()
+            for handler in handlers.get(type(event), ()):
+                handler(event)
+
+class PriorityEventBus(EventBus):
+    """
+    按优先级及写入顺序处理事件的分发器（回测默认），基于heapq
+    优先级由event.priority决定，数值越小越先处理，同一优先级按写入顺序处理：
+    FILL(0) > 卖出ORDER(1) > 买入ORDER(2) > MARKET(3)
+    handlebar产生的一批委托中，卖出委托先于买入委托处理，且每笔委托的成交回报在下一笔委托之前处理，
+    处理顺序为Order-Fill-Order-Fill，卖出所得资金可以及时用于同一根K线内的买入
+    """
+
+    def __init__(self):
+        EventBus.__init__(self)
+        self.queue = []
+        self.counter = itertools.count() # 写入序号，保证同一优先级按写入顺序处理
+
+    def put(self, event):
+        heapq.heappush(self.queue, (event.priority, next(self.counter), event))
+
+    def dispatch(self):
+        events = self.queue
+        handlers = self.handlers
+        pop = heapq.heappop
+        while events:
+            event = pop(events)[2]
+            for handler in handlers.get(type(event), ()):
+                handler(event)
+
+class QueueEventBus(EventBus):
+    """
+    线程安全的事件分发器，基于queue.Queue，仅在实盘或多线程模式下使用
+    """
+
+    def __init__(self):
+        EventBus.__init__(self)
+        self.queue = queue.Queue()
+
+    def put(self, event):
+        self.queue.put(event)
+
+    def empty(self):
+        return self.queue.empty()
+
+    def dispatch(self):
+        handlers = self.handlers
+        while True:
+            try:
+                event = self.queue.get(False)
+            except queue.Empty: # 事件队列为空，结束处理
+                break
+            for handler in handlers.get(type(event), ()):
+                handler(event)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+策略技术指标：在initialize()中注册，按面板数据（日期×代码）整体向量化计算
+handlebar中只需按当前游标读取指标值，不再逐日构建数据窗口重复计算
+所有指标第i行只使用第i行及之前的数据，按游标读取不会产生未来函数
+未上市日期的数据视为缺失值（NaN），不参与计算
+"""
+
+import numpy as np
+
+def _rolling_sum(x, window):
+    """
+    计算滚动窗口内有效值之和及有效值个数，NaN视为缺失
+    基于累计和实现，每个窗口O(1)，支持一维及二维数组（按行滚动）
+    """
+    valid = ~np.isnan(x)
+    n_rows = x.shape[0]
+    cs = np.zeros((n_rows+1,)+x.shape[1:])
+    np.cumsum(np.where(valid, x, 0.), axis=0, out=cs[1:])
+    cn = np.zeros((n_rows+1,)+x.shape[1:], dtype=np.int64)
+    np.cumsum(valid, axis=0, out=cn[1:])
+    s = cs[1:].copy()
+    n = cn[1:].copy()
+    if window < n_rows:
+        s[window:] -= cs[1:n_rows+1-window]
+        n[window:] -= cn[1:n_rows+1-window]
+    return s, n
+
+def _column_mean(x):
+    """
+    各列有效值的均值，全部为NaN的列（如整个区间未上市）均值按0处理，不产生空切片警告
+    """
+    valid = ~np.isnan(x)
+    n = valid.sum(axis=0)
+    return np.where(valid, x, 0.).sum(axis=0)/np.maximum(n, 1)
+
+def _center(x):
+    """
+    各列减去其均值，减少累计和相减时的精度损失（不影响方差、回归斜率等结果）
+    """
+    return x-_column_mean(x)
+
+def sma(x, window, min_periods=None):
+    """
+    简单移动平均，与其他滚动指标一致，先减去列均值再计算累计和，结果加回均值
+    """
+    if min_periods is None:
+        min_periods = window
+    mean = _column_mean(x)
+    s, n = _rolling_sum(x-mean, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = s/n+mean
+    out[n < max(min_periods, 1)] = np.nan
+    return out
+
+def ema(x, span):
+    """
+    指数移动平均，alpha=2/(span+1)，从第一个有效值开始递推，缺失值沿用前值
+    """
+    alpha = 2./(span+1)
+    out = np.empty(x.shape)
+    prev = np.full(x.shape[1:], np.nan)
+    for i in range(x.shape[0]):
+        cur = x[i]
+        prev = np.where(np.isnan(prev), cur, np.where(np.isnan(cur), prev, alpha*cur+(1-alpha)*prev))
+        out[i] = prev
+    return out
+
+def rolling_std(x, window, ddof=0, min_periods=None):
+    """
+    滚动标准差，默认为总体标准差（与np.std一致）
+    """
+    if min_periods is None:
+        min_periods = window
+    x = _center(x)
+    s, n = _rolling_sum(x, window)
+    s2, _ = _rolling_sum(x*x, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = (s2-s*s/n)/(n-ddof)
+    out = np.sqrt(np.maximum(var, 0.))
+    out[n < max(min_periods, ddof+1)] = np.nan
+    return out
+
+def rolling_ols(x, y, window, min_periods=None):
+    """
+    滚动一元线性回归 y = alpha + beta*x，返回斜率beta及决定系数R²
+    由x、y、x²、y²、xy的累计和直接求解，一次计算全部窗口，无需逐窗口拟合
+    """
+    if min_periods is None:
+        min_periods = window
+    valid = ~(np.isnan(x) | np.isnan(y))
+    x = _center(np.where(valid, x, np.nan))
+    y = _center(np.where(valid, y, np.nan))
+    sx, n = _rolling_sum(x, window)
+    sy, _ = _rolling_sum(y, window)
+    sxx, _ = _rolling_sum(x*x, window)
+    syy, _ = _rolling_sum(y*y, window)
+    sxy, _ = _rolling_sum(x*y, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = sxy-sx*sy/n
+        var_x = sxx-sx*sx/n
+        var_y = syy-sy*sy/n
+        beta = cov/var_x
+        r2 = cov*cov/(var_x*var_y)
+    # 窗口数据不足或x无波动（如长期停牌）时，回归无意义
+    invalid = (n < max(min_periods, 2)) | ~(var_x > 1e-12*np.maximum(sxx, 1.))
+    beta[invalid] = np.nan
+    r2[invalid] = np.nan
+    r2[~invalid & ~(var_y > 1e-12*np.maximum(syy, 1.))] = 1.
+    return beta, r2
+
+def rolling_zscore(x, window, min_periods=None):
+    """
+    滚动标准分：当前值与最近window个值（含当前值）均值之差，除以其总体标准差
+    """
+    m = sma(x, window, min_periods)
+    sd = rolling_std(x, window, 0, min_periods)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = (x-m)/sd
+    out[~(sd > 0)] = np.nan
+    return out
+
+def rsrs(low, high, window=200, z_window=100):
+    """
+    RSRS指标：最高价对最低价的滚动回归斜率beta，及其在最近z_window个beta中的标准分乘以R²
+    返回beta、R²及RSRS指标值
+    """
+    beta, r2 = rolling_ols(low, high, window)
+    return beta, r2, r2*rolling_zscore(beta, z_window)
+
+def rsi(x, window=14, min_periods=None):
+    """
+    相对强弱指标RSI，涨跌幅均值采用简单移动平均
+    """
+    diff = np.full(x.shape, np.nan)
+    diff[1:] = x[1:]-x[:-1]
+    gain = np.where(np.isnan(diff), np.nan, np.maximum(diff, 0.))
+    loss = np.where(np.isnan(diff), np.nan, np.maximum(-diff, 0.))
+    avg_gain = sma(gain, window, min_periods)
+    avg_loss = sma(loss, window, min_periods)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = 100.-100./(1.+avg_gain/avg_loss)
+    out[(avg_loss == 0) & (avg_gain > 0)] = 100.
+    out[(avg_loss == 0) & (avg_gain == 0)] = 50.
+    return out
+
+class Indicators(object):
+    """
+    指标管理类，由Strategy创建，在initialize()中注册指标，在handlebar()中读取当前值
+    例：self.indicators.add('ma_10', indicator.sma, 'close', window=10)
+        ma_10 = self.indicators.get('ma_10', sym)
+    """
+
+    def __init__(self, bars):
+        self.bars = bars
+        self.values = {} # 指标名称 -> 日期×代码的二维数组
+        self.inputs = {} # 字段名称 -> 未上市日期置为NaN的浮点数组
+
+    def get_input(self, field):
+        """
+        获取指标计算使用的字段数据，未上市日期置为NaN
+        """
+        if field not in self.inputs:
+            panel = self.bars.panel
+            self.inputs[field] = np.where(panel.listed, panel.fields[field], np.nan)
+        return self.inputs[field]
+
+    def add(self, name, func, fields='close', **params):
+        """
+        注册指标并立即完成向量化计算
+        fields为单个字段或字段元组，按顺序作为func的输入；params为func的其他参数
+        func返回多个数组时（如rolling_ols），name需为对应的名称元组
+        """
+        if isinstance(fields, str):
+            fields = (fields,)
+        result = func(*[self.get_input(field) for field in fields], **params)
+        if isinstance(name, str):
+            self.values[name] = result
+        else:
+            for n, r in zip(name, result):
+                self.values[n] = r
+
+    def get(self, name, sym):
+        """
+        获取单只股票当前的指标值
+        """
+        return self.values[name][self.bars.bar_index, self.bars.panel.symbol_index[sym]]
+
+    def get_row(self, name):
+        """
+        获取全部代码当前的指标值，列顺序与bars.full_list一致
+        """
+        return self.values[name][self.bars.bar_index]
+
+    def get_window(self, name, sym, N=1):
+        """
+        获取单只股票最近N个指标值
+        """
+        end = self.bars.bar_index+1
+        return self.values[name][max(end-N, 0):end, self.bars.panel.symbol_index[sym]]
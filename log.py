@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+日志模块，基于标准库logging
+各模块通过get_logger()获取日志对象，按级别输出：DEBUG为逐笔委托及交易信号，INFO为回测进度及耗时
+日志参数在输出时才格式化，级别关闭时仅有一次级别判断的开销
+委托被拒绝的原因以RejectCode枚举记录在环形缓冲区（RejectionLog）中，可导出为CSV
+"""
+
+import logging
+from collections import deque
+from enum import IntEnum
+
+import pandas as pd
+
+logger = logging.getLogger('zqbt')
+
+def get_logger(name):
+    """
+    获取模块日志对象，均为zqbt日志的子日志
+    """
+    return logging.getLogger('zqbt.'+name)
+
+def set_level(level):
+    """
+    设置日志级别（'DEBUG'/'INFO'/'WARNING'等），首次调用时添加控制台输出
+    """
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('[%(asctime)s]%(message)s', '%Y-%m-%d %H:%M:%S'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level)
+
+class RejectCode(IntEnum):
+    """
+    委托被拒绝的原因
+    """
+    SUSPENDED = 1 # 股票当日停牌
+    LIMIT_UP = 2 # 股票当日涨停，不能买入
+    LIMIT_DOWN = 3 # 股票当日跌停，不能卖出
+    QUANTITY = 4 # 委托数量错误
+    CASH = 5 # 可用资金不足
+    POSITION = 6 # 可用持仓不足
+
+class RejectionLog(object):
+    """
+    委托拒绝记录，环形缓冲区只保留最近maxlen条，counts记录各原因的累计次数
+    """
+
+    def __init__(self, maxlen=100000):
+        self.records = deque(maxlen=maxlen)
+        self.counts = dict.fromkeys(RejectCode, 0)
+
+    def append(self, date_time, symbol, code, order_price, order_amount):
+        self.records.append((date_time, symbol, code, order_price, order_amount))
+        self.counts[code] += 1
+
+    def __len__(self):
+        return len(self.records)
+
+    def to_frame(self):
+        """
+        转换为DataFrame，reason列为RejectCode的名称
+        """
+        df = pd.DataFrame(list(self.records),
+                          columns=['date_time','symbol','code','order_price','order_amount'])
+        df['reason'] = [RejectCode(code).name for code in df['code']]
+        return df
+
+    def download(self, file_name='logs/rejection_records.csv'):
+        """
+        导出委托拒绝记录
+        """
+        self.to_frame().to_csv(file_name)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""
+批量撮合：一次撮合同一根K线的全部委托，不涉及具体的事件循环
+委托以数组形式输入（代码列号、委托数量、委托价格），按输入顺序依次判断，规则与broker.SimulatedExecution一致：
+停牌不成交、涨停不买跌停不卖（±9.98%）、委托价优于收盘价时按收盘价成交、委托数量向下取整百、
+手续费不低于最低手续费、买入检查可用资金、卖出检查可用持仓（含本批次前序委托的变动）
+安装numba时使用编译后的逐笔撮合；否则使用NumPy向量化撮合，仅在资金不足或同一代码多笔委托时逐笔判断
+手续费按分舍入，结果与execute_order中Python的round(x, 2)一致（见_round_cent）
+"""
+
+import numpy as np
+
+from log import RejectCode
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# 拒绝原因编码（见log.RejectCode），0为成交
+SUSPENDED = int(RejectCode.SUSPENDED)
+LIMIT_UP = int(RejectCode.LIMIT_UP)
+LIMIT_DOWN = int(RejectCode.LIMIT_DOWN)
+QUANTITY = int(RejectCode.QUANTITY)
+CASH = int(RejectCode.CASH)
+POSITION = int(RejectCode.POSITION)
+
+def _cent_error(x):
+    """
+    返回x*100的浮点结果及其舍入误差（Veltkamp拆分，误差可精确计算），支持标量及数组
+    """
+    y = x*100.
+    c = 134217729.*x
+    high = c-(c-x)
+    return y, (high*100.-y)+(x-high)*100.
+
+def _round_cent(x):
+    """
+    按分舍入，与Python的round(x, 2)一致：x*100的浮点结果恰为半分时，由舍入误差判断真实值在半分的哪一侧
+    （如12.05*93000*0.0003=336.19499...，np.rint(x*100)/100得336.2，round()得336.19），真实值恰为半分时取偶数
+    """
+    y, err = _cent_error(x)
+    floor = np.floor(y)
+    if y-floor == 0.5 and err != 0:
+        return (floor+1. if err > 0 else floor)/100.
+    return np.rint(y)/100.
+
+def _round_cents(x):
+    """
+    _round_cent的数组版本
+    """
+    y, err = _cent_error(x)
+    floor = np.floor(y)
+    return np.where((y-floor == 0.5) & (err != 0), np.where(err > 0, floor+1, floor), np.rint(y))/100.
+
+def _match_loop(cols, qty, price, close, pct_chg, suspended, positions, cash,
+                commission_rate, min_commission):
+    """
+    逐笔撮合（可由numba编译），positions为可用持仓的副本，撮合过程中随成交更新
+    """
+    n = len(cols)
+    amount = np.zeros(n, dtype=np.int64)
+    fill_price = price.copy()
+    commission = np.zeros(n)
+    code = np.zeros(n, dtype=np.int64)
+    for k in range(n):
+        j = cols[k]
+        q = qty[k]
+        # 判断是否停牌及涨/跌停
+        if suspended[j]:
+            code[k] = SUSPENDED
+            continue
+        if q > 0 and pct_chg[j] >= 9.98:
+            code[k] = LIMIT_UP
+            continue
+        if q < 0 and pct_chg[j] <= -9.98:
+            code[k] = LIMIT_DOWN
+            continue
+
+        # 市价单（NaN）及优于收盘价的委托按收盘价成交
+        p = price[k]
+        if np.isnan(p) or (q < 0 and p > close[j]) or (q > 0 and p < close[j]):
+            p = close[j]
+        fill_price[k] = p
+
+        # 委托数量向下取整百
+        a = np.int64(np.floor(q/100)*100)
+        amount[k] = a
+        if a == 0:
+            code[k] = QUANTITY
+            continue
+
+        fee = max(_round_cent(p*abs(a)*commission_rate), min_commission)
+        commission[k] = fee
+
+        # 判断现金及持仓是否可用
+        if a > 0:
+            if a*p > cash:
+                code[k] = CASH
+                continue
+        elif a < -positions[j]:
+            code[k] = POSITION
+            continue
+
+        cash -= p*a+fee
+        positions[j] += a
+    return amount, fill_price, commission, code
+
+def _match_numpy(cols, qty, price, close, pct_chg, suspended, positions, cash,
+                 commission_rate, min_commission):
+    """
+    向量化撮合，结果与_match_loop一致
+    """
+    n = len(cols)
+    code = np.zeros(n, dtype=np.int64)
+    code[suspended[cols]] = SUSPENDED
+    pct = pct_chg[cols]
+    code[(code == 0) & (qty > 0) & (pct >= 9.98)] = LIMIT_UP
+    code[(code == 0) & (qty < 0) & (pct <= -9.98)] = LIMIT_DOWN
+    active = code == 0
+
+    last_close = close[cols]
+    better = np.isnan(price) | ((qty < 0) & (price > last_close)) | ((qty > 0) & (price < last_close))
+    fill_price = np.where(active & better, last_close, price)
+
+    amount = np.where(active, np.floor(qty/100)*100, 0).astype(np.int64)
+    code[active & (amount == 0)] = QUANTITY
+    active = code == 0
+    commission = np.where(active, np.maximum(_round_cents(fill_price*np.abs(amount)*commission_rate),
+                                             min_commission), 0.)
+
+    # 同一代码有多笔委托时，可用持仓依赖前序成交，逐笔判断
+    if len(np.unique(cols[active])) < active.sum():
+        return _match_loop(cols, qty, price, close, pct_chg, suspended, positions.copy(), cash,
+                           commission_rate, min_commission)
+    code[active & (amount < -positions[cols])] = POSITION
+    active = code == 0
+
+    # 按顺序检查可用资金，假设前序委托全部成交，资金充足时（通常情况）一次判断全部委托
+    ok = np.flatnonzero(active)
+    cost = fill_price[ok]*amount[ok]+commission[ok]
+    running = np.subtract.accumulate(np.concatenate(([cash], cost)))[:-1]
+    if (amount[ok]*fill_price[ok] > running)[amount[ok] > 0].any():
+        for k, c in zip(ok, cost):
+            if amount[k] > 0 and amount[k]*fill_price[k] > cash:
+                code[k] = CASH
+            else:
+                cash -= c
+    return amount, fill_price, commission, code
+
+if numba is not None:
+    _cent_error = numba.njit(cache=True)(_cent_error)
+    _round_cent = numba.njit(cache=True)(_round_cent)
+    _match_loop = numba.njit(cache=True)(_match_loop)
+
+def match_orders(cols, qty, price, close, pct_chg, suspended, positions, cash,
+                 commission_rate, min_commission):
+    """
+    撮合一批委托，按输入顺序依次判断
+    cols、qty、price：委托代码的列号、委托数量（正数买入，负数卖出）、委托价格（NaN为市价单）
+    close、pct_chg、suspended：当前K线全部代码的收盘价、涨跌幅、停牌标记（按列号索引）
+    positions、cash：当前可用持仓（按列号索引，不会被修改）及可用资金
+    返回成交数量、成交价格、手续费及拒绝原因（0为成交）；停牌及涨跌停的委托未取整，成交数量为0
+    """
+    cols = np.asarray(cols, dtype=np.int64)
+    qty = np.asarray(qty, dtype=np.float64)
+    price = np.asarray(price, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.int64)
+    if numba is not None:
+        return _match_loop(cols, qty, price, close, pct_chg, suspended, positions.copy(), float(cash),
+                           float(commission_rate), float(min_commission))
+    return _match_numpy(cols, qty, price, close, pct_chg, suspended, positions, cash,
+                        commission_rate, min_commission)
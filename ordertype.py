@@ -32,7 +32,7 @@ class Order(object):
 
     # 按委托的目标金额下单，需要提供持仓信息，不填价格则默认为市价单
     def order_target_value(self, symbol, target_value, price='MARKET'):
-        cur_hold = self.portfolio.holdings[symbol] # 获取当前市值
+        cur_hold = self.portfolio.get_holding(symbol) # 获取当前市值
         value = target_value-cur_hold # 计算市值差额
         if price == 'MARKET': # 市价单则委托价为收盘价
             price = self.bars.get_latest_bar(symbol)['close']
@@ -43,7 +43,7 @@ class Order(object):
 
     # 按委托的目标数量下单，需要提供持仓信息，不填价格则默认为市价单
     def order_target_share(self, symbol, target_share, price='MARKET'):
-        cur_pos = self.portfolio.positions[symbol] # 获取当前持仓
+        cur_pos = self.portfolio.get_position(symbol) # 获取当前持仓
         if price == 'MARKET': # 市价单则委托价为收盘价
             price = self.bars.get_latest_bar(symbol)['close']
         qty = target_share-cur_pos # 计算委托数量
@@ -84,4 +84,4 @@ def order_target_share(events, bars, portfolio, symbol, target_share, price='MAR
     qty = target_share-cur_pos # 计算委托数量
     my_order = OrderEvent(symbol, qty, price)
     events.put(my_order)
-'''
\ No newline at end of file
+'''
\ No newline at end of file
@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import pandas as pd
 
+from analysis import OnlineMetrics
+
+# 历史持仓矩阵（日期×代码）元素个数不超过该值时使用稠密数组，否则按稀疏格式（COO）只记录非零持仓
+DENSE_HISTORY_LIMIT = 20000000
+
 class Portfolio(object):
     """
     Portfolio类处理所有的持仓和市场价值，针对在每个时间点上的数据的情况
-    Positions DataFrame存放一个用时间做索引的持仓数量
-    Holdings DataFrame存放特定时间索引对应的每个代码的现金和总的市场持仓价值
+    实时持仓为与symbol_list对齐的数组（即面板数据的前len(symbol_list)列），持仓市值=持仓数量*收盘价
+    历史持仓按回测天数预先分配为日期×代码的二维数组，持仓稀疏时只记录非零持仓；
+    历史市值不逐日保存，导出时由历史持仓及收盘价计算
+    持仓代码集合在update_fill中增量维护，每日计算市值及获取持仓代码只涉及持仓股票，与股票池大小无关
+    metrics为逐日增量计算的风险指标（analysis.OnlineMetrics），回测过程中可随时读取
     """
 
     def __init__(self, events, ContextInfo, bars):
@@ -18,119 +27,163 @@ class Portfolio(object):
         self.start_date = ContextInfo.start_date
         self.end_date = ContextInfo.end_date
 
-        # 历史持仓/市值，格式为List
-        #self.all_positions = pd.DataFrame()
-        #self.all_holdings = pd.DataFrame()
-        self.all_positions = []
-        self.all_holdings = []
-        # 实时持仓/市值，格式为Dictionary
-        self.positions = self.set_positions()
-        self.holdings = self.set_holdings()
-        #print(len(self.positions))
+        # 实时持仓/现金/总资产
+        self.symbol_index = {sym: j for j, sym in enumerate(self.symbol_list)}
+        self.positions = np.zeros(len(self.symbol_list), dtype=np.int64)
+        self.held = set() # 持仓不为0的代码列号
+        self.held_index = np.zeros(0, dtype=np.intp) # 排序后的持仓列号，持仓代码变化时重建
+        self.cash = self.initial_capital
+        self.mkt_value = self.initial_capital
+        self.date_time = self.bars.start_date
+        self.metrics = OnlineMetrics()
+        self.benchmark_index = self.bars.panel.symbol_index[self.benchmark]
+
+        # 历史持仓/现金/总资产，按回测天数预先分配
+        self.first_index = self.bars.bar_index+1 # 回测第一根K线在面板中的行号
+        self.n_records = 0
+        n_days = self.bars.last_index-self.bars.bar_index
+        self.all_cash = np.empty(n_days)
+        self.all_mkt_value = np.empty(n_days)
+        self.sparse = n_days*len(self.symbol_list) > DENSE_HISTORY_LIMIT
+        if self.sparse:
+            # 稀疏格式：每日非零持仓的列号及数量，all_offsets[k]为第k日记录的起始位置
+            self.all_offsets = np.zeros(n_days+1, dtype=np.int64)
+            self.all_cols = []
+            self.all_amounts = []
+        else:
+            self.all_positions = np.zeros((n_days, len(self.symbol_list)), dtype=np.int64)
+
+    def get_close(self):
+        """
+        获取symbol_list当前的收盘价（面板数据的行视图，不复制）
+        """
+        return self.bars.panel.fields['close'][self.bars.bar_index, :len(self.symbol_list)]
 
-    def set_positions(self):
+    def update_portfolios(self):
         """
-        构造完整的持仓矩阵
+        在历史持仓中根据当前持仓增加一行，反映最新的持仓情况
         """
-        pos = dict()
-        pos['date_time'] = self.bars.start_date
-        pos['cash'] = self.initial_capital
-        for sym in self.symbol_list:
-            pos[sym] = 0
-
-        return pos # 返回一个Dict，包含日期、现金及代码持仓
+        # 更新日期（以基准的日期序列为准）
+        self.date_time = self.bars.get_latest_bar(self.benchmark)['date_time']
+
+        # 更新当前总资产
+        idx = self.held_index
+        self.mkt_value = self.cash+np.dot(self.positions[idx], self.get_close()[idx])
+
+        # 更新增量风险指标
+        self.metrics.update(self.mkt_value,
+                            self.bars.panel.fields['close'][self.bars.bar_index, self.benchmark_index],
+                            self.date_time)
+
+        # 写入历史持仓/现金/总资产
+        k = self.n_records
+        self.all_cash[k] = self.cash
+        self.all_mkt_value[k] = self.mkt_value
+        if self.sparse:
+            self.all_cols.append(self.held_index)
+            self.all_amounts.append(self.positions[self.held_index])
+            self.all_offsets[k+1] = self.all_offsets[k]+len(self.held_index)
+        else:
+            self.all_positions[k] = self.positions
+        self.n_records += 1
 
-    def set_holdings(self):
+    def update_fill(self, event):
         """
-        构造完整的市值矩阵
+        在接收到Fill事件后，更新当前持仓
         """
-        hold = dict()
-        hold['date_time'] = self.bars.start_date
-        hold['cash'] = self.initial_capital
-        for sym in self.symbol_list:
-            hold[sym] = 0
-        hold['mkt_value'] = self.initial_capital
+        self.cash -= event.order_price*event.order_amount+event.commission
+        j = self.symbol_index[event.symbol]
+        self.positions[j] += event.order_amount
 
-        return hold # 返回一个Dict，包含日期、现金及代码市值
+        # 更新持仓代码集合
+        if self.positions[j] != 0:
+            if j not in self.held:
+                self.held.add(j)
+                self.held_index = np.array(sorted(self.held), dtype=np.intp)
+        elif j in self.held:
+            self.held.discard(j)
+            self.held_index = np.array(sorted(self.held), dtype=np.intp)
 
-    def update_portfolios(self):
+    def update_fills(self, cols, order_amount, cost):
         """
-        在持仓列表当中根据当前持仓增加一行，反映最新的持仓情况
+        批量更新持仓（向量化回测使用），cols为成交代码的列号，cost为各笔成交的现金支出（含手续费）
+        现金按成交顺序依次扣减，与逐笔调用update_fill的结果一致
         """
-        # 更新日期（以基准的日期序列为准）
-        self.positions['date_time'] = self.bars.get_latest_bar(
-            self.benchmark
-        )['date_time']
-        self.holdings['date_time'] = self.positions['date_time']
-
-        # 更新当前市值
-        self.holdings['cash'] = self.positions['cash']
-        mkt_value = 0 # 持仓总市值
-        for sym in self.symbol_list:
-            self.holdings[sym] = self.bars.get_latest_bar(sym)['close']*self.positions[sym]
-            mkt_value += self.holdings[sym]
-        self.holdings['mkt_value'] = self.holdings['cash']+mkt_value
-
-        # 更新到历史持仓/市值列表
-        #self.all_positions = self.all_positions.append(self.positions,ignore_index=True)
-        #self.all_holdings = self.all_holdings.append(self.holdings,ignore_index=True)
-        self.all_positions.append(self.positions.copy())
-        self.all_holdings.append(self.holdings.copy())
+        self.cash = np.subtract.accumulate(np.concatenate(([self.cash], cost)))[-1]
+        self.positions[cols] += order_amount
+        held = self.positions[cols] != 0
+        self.held.update(cols[held].tolist())
+        self.held.difference_update(cols[~held].tolist())
+        self.held_index = np.array(sorted(self.held), dtype=np.intp)
 
-    def update_fill(self, event):
+    def get_history(self):
         """
-        在接收到Fill事件后，更新当前持仓
+        获取历史持仓（日期×代码的稠密数组），稀疏格式时在此展开
         """
-        sym = event.symbol
-        order_amount = event.order_amount
-        order_price = event.order_price
-        commission = event.commission
+        n = self.n_records
+        if not self.sparse:
+            return self.all_positions[:n]
+        all_positions = np.zeros((n, len(self.symbol_list)), dtype=np.int64)
+        if n > 0:
+            rows = np.repeat(np.arange(n), np.diff(self.all_offsets[:n+1]))
+            all_positions[rows, np.concatenate(self.all_cols)] = np.concatenate(self.all_amounts)
+        return all_positions
 
-        self.positions['cash'] -= order_price*order_amount+commission
-        self.positions[sym] += order_amount
-        #print(self.positions)
+    def get_dates(self):
+        """
+        获取回测期间的日期序列
+        """
+        return self.bars.panel.dates[self.first_index:self.first_index+self.n_records]
+
+    def get_equity(self):
+        """
+        获取回测期间每日的总资产
+        """
+        return self.all_mkt_value[:self.n_records]
 
     def download_portfolios(self):
         """
         导出回测期间每日的持股数及市值
         """
-        all_positions = pd.DataFrame(self.all_positions)
-        all_holdings = pd.DataFrame(self.all_holdings)
+        all_positions = self.get_history()
+        all_holdings = all_positions*self.bars.panel.fields['close'][
+            self.first_index:self.first_index+self.n_records, :len(self.symbol_list)]
 
-        df = pd.DataFrame()
-        df['date_time'] = all_positions['date_time']
-        df['cash'] = all_positions['cash']
-        for sym in self.symbol_list:
-            df['pos_'+sym] = all_positions[sym]
-            df['mkv_'+sym] = all_holdings[sym]
-        df['mkt_value'] = all_holdings['mkt_value']
+        columns = {'date_time': self.get_dates(), 'cash': self.all_cash[:self.n_records]}
+        for j, sym in enumerate(self.symbol_list):
+            columns['pos_'+sym] = all_positions[:, j]
+            columns['mkv_'+sym] = all_holdings[:, j]
+        columns['mkt_value'] = self.get_equity()
 
-        df.to_csv('logs/portfolio_records.csv')
+        pd.DataFrame(columns).to_csv('logs/portfolio_records.csv')
 
     def get_cash(self):
         """
         获取可用资金
         """
-        return self.positions['cash']
+        return self.cash
 
     def get_mkv(self):
         """
         获取总资产
         """
-        return self.holdings['mkt_value']
+        return self.mkt_value
 
     def get_position(self,sym):
         """
         获取单只股票的持仓数量
         """
-        return self.positions[sym]
+        return self.positions[self.symbol_index[sym]]
+
+    def get_holding(self,sym):
+        """
+        获取单只股票的持仓市值（按当前收盘价计算）
+        """
+        j = self.symbol_index[sym]
+        return self.positions[j]*self.get_close()[j]
 
     def get_positions(self):
         """
-        获取所有持仓股票代码
+        获取所有持仓股票代码，顺序与symbol_list一致
         """
-        current_pos = []
-        for sym in self.symbol_list:
-            if self.positions[sym] != 0:
-                current_pos.append(sym)
-        return current_pos
\ No newline at end of file
+        return [self.symbol_list[j] for j in self.held_index]
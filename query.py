@@ -1,66 +1,208 @@
 # -*- coding: utf-8 -*-
 
-from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import os
 
+from log import get_logger
+
+logger = get_logger('query')
+
 # 提供股票数据的综合查询，包括基本面数据、行业数据等
 # 仅在Strategy中使用，不参与到具体的事件循环
 
-# 优化：直接init加载所有symbol_list的基本面数据至dict，后续可读取
+# 行业分类只读取一次并建立双向索引；个股财务指标按需加载，以LRU方式保留最近使用的股票
 
-# 获取个股所属行业（申万分类）
-def get_industry(symbol):
-    df = pd.read_csv('database/swclass.csv',encoding="gbk")
-    return(df[df['symbol']==symbol]['industry'].values[0])
+MFI_PATH = 'database/mfi_data' # 财务指标CSV文件路径（见data_processor）
+SWCLASS_FILE = 'database/swclass.csv' # 申万行业分类
 
-# 获取行业成分股（申万分类）
-def get_industry_stock(industry):
-    df = pd.read_csv('database/swclass.csv',encoding="gbk")
-    #return (df[df['industry'] == industry].reset_index(drop=True))
-    return(list(df[df['industry']==industry]['symbol']))
+# 各报告期的法定披露截止日：报告期（月-日） -> (年份偏移, 截止日（月-日）)
+# 一季报4月30日、半年报8月31日、三季报10月31日、年报次年4月30日
+DISCLOSURE_DEADLINES = {'03-31': (0, '04-30'), '06-30': (0, '08-31'),
+                        '09-30': (0, '10-31'), '12-31': (1, '04-30')}
+DEFAULT_DISCLOSURE_LAG = 120 # 非标准报告期在报告期后延迟生效的自然日数
 
-# 获取个股EPS
-def get_eps(symbol):
-    df = pd.read_csv('database/mfi_data/%s.csv'%symbol,encoding="gbk")
-    return(df[['post_date','eps']])
+class Fundamentals(object):
+    """
+    基本面数据服务：行业分类及个股财务指标
+    财务指标在首次使用时读取，最多缓存max_symbols只股票，超出时淘汰最久未使用的股票
+    as_of()按财务数据的生效日（见get_effective_date）二分查找，只返回指定日期已披露的数据，避免未来函数
+    """
 
-# 获取个股ROC
-def get_roc(symbol):
-    df = pd.read_csv('database/mfi_data/%s.csv'%symbol,encoding="gbk")
-    return(df[['post_date','roc']])
+    def __init__(self, max_symbols=512):
+        self.max_symbols = max_symbols
+        self.mfi_data = OrderedDict() # 代码 -> (按post_date排序的DataFrame, post_date数组)
+        self.effective_dates = {} # (代码, lag) -> 生效日数组，随mfi_data一起淘汰
+        self.industry_stocks = None # 行业 -> 成分股列表
+        self.stock_industry = None # 代码 -> 行业
+
+    def load_industry(self):
+        """
+        读取行业分类并建立行业->成分股、代码->行业的索引
+        """
+        df = pd.read_csv(SWCLASS_FILE,encoding="gbk")
+        self.stock_industry = dict(zip(df['symbol'],df['industry']))
+        self.industry_stocks = {}
+        for sym, industry in zip(df['symbol'],df['industry']):
+            self.industry_stocks.setdefault(industry,[]).append(sym)
 
-'''
-class MainFinancialIndex(object):
+    def get_industry(self, symbol):
+        """
+        获取个股所属行业（申万分类）
+        """
+        if self.stock_industry is None:
+            self.load_industry()
+        return self.stock_industry[symbol]
+
+    def get_industry_stock(self, industry):
+        """
+        获取行业成分股（申万分类）
+        """
+        if self.industry_stocks is None:
+            self.load_industry()
+        return list(self.industry_stocks.get(industry,[]))
+
+    def load_mfi(self, symbol):
+        """
+        获取个股财务指标及post_date数组，优先使用缓存
+        """
+        if symbol in self.mfi_data:
+            self.mfi_data.move_to_end(symbol)
+            return self.mfi_data[symbol]
+        df = pd.read_csv(os.path.join(MFI_PATH,'%s.csv'%symbol),encoding="gbk",index_col=0)
+        df['post_date'] = df['post_date'].astype(str)
+        for col in df.columns:
+            if col != 'post_date': # 原始数据中缺失值为'--'等文本
+                df[col] = pd.to_numeric(df[col],errors='coerce')
+        df = df.sort_values('post_date',kind='mergesort').reset_index(drop=True)
+        self.mfi_data[symbol] = (df, df['post_date'].to_numpy())
+        if len(self.mfi_data) > self.max_symbols:
+            evicted = self.mfi_data.popitem(last=False)[0]
+            for key in [key for key in self.effective_dates if key[0] == evicted]:
+                del self.effective_dates[key]
+        return self.mfi_data[symbol]
+
+    def get_effective_date(self, symbol, lag=None):
+        """
+        获取个股各期财务数据的生效日数组（与post_date对齐），lag含义同get_effective_date
+        """
+        post_date = self.load_mfi(symbol)[1]
+        key = (symbol, lag)
+        if key not in self.effective_dates:
+            self.effective_dates[key] = get_effective_date(post_date, lag)
+        return self.effective_dates[key]
+
+    def get_mfi(self, symbol, fields=None):
+        """
+        获取个股全部历史财务指标，fields为字段列表，为空时返回全部字段
+        """
+        df = self.load_mfi(symbol)[0]
+        if fields is None:
+            return df.copy()
+        return df[['post_date']+list(fields)]
+
+    def as_of(self, symbol, date, fields=None, lag=None):
+        """
+        获取个股在date（含）已生效的最近一期财务指标（Series），没有已生效的数据时返回None
+        lag为None（默认）时按法定披露截止日生效，与FactorMatrix一致；lag=0即按报告期（存在未来函数）
+        """
+        effective_date = self.get_effective_date(symbol, lag)
+        df = self.load_mfi(symbol)[0]
+        k = np.searchsorted(effective_date,str(date),side='right')-1
+        if k < 0:
+            return None
+        row = df.iloc[k]
+        return row if fields is None else row[['post_date']+list(fields)]
+
+# 默认的基本面数据服务，下列查询函数共用
+fundamentals = Fundamentals()
+
+def get_effective_date(post_date, lag=None):
     """
-    MainFinancialIndex类用来读取请求的代码的财务指标数据
-    财务指标数据以CSV文件形式存储在磁盘上。
+    由报告期（post_date）计算财务数据可以使用的日期，返回与post_date等长的日期字符串数组
+    lag为None时按报告期的法定披露截止日（见DISCLOSURE_DEADLINES），非标准报告期按DEFAULT_DISCLOSURE_LAG；
+    lag为整数时统一按报告期后lag个自然日，lag=0即报告期当日可用（存在未来函数，仅用于对比）
+    结果按报告期顺序保持非递减，可直接二分查找
     """
-    def __init__(self, ContextInfo):
-        self.symbol_list = ContextInfo.symbol_list
-        self.benchmark = ContextInfo.benchmark
-
-        self.full_list = self.symbol_list+[self.benchmark] # 代码列表+基准
-        #self.full_list = self.symbol_list
+    post_date = pd.to_datetime(pd.Series(post_date))
+    if lag is not None:
+        effective = post_date+pd.Timedelta(days=lag)
+    else:
+        effective = post_date+pd.Timedelta(days=DEFAULT_DISCLOSURE_LAG)
+        month_day = post_date.dt.strftime('%m-%d')
+        for period, (years, deadline) in DISCLOSURE_DEADLINES.items():
+            match = month_day == period
+            if match.any():
+                effective[match] = pd.to_datetime((post_date[match].dt.year+years).astype(str)+'-'+deadline)
+    effective = np.maximum.accumulate(effective.to_numpy()) if len(effective) else effective.to_numpy()
+    return pd.DatetimeIndex(effective).strftime('%Y-%m-%d').to_numpy()
 
-        # Dictionary形式储存数据，Key为Symbol，Value为对应的DataFrame
-        self.mfi_data = {}
+class FactorMatrix(object):
+    """
+    财务指标的时点截面数据：每个字段为日期×代码的矩阵，行与行情面板的交易日对齐，列与bars.symbol_list对齐
+    post_date为报告期而非披露日，每个交易日取该日（含）之前已披露的最近一期数据（前向填充），没有数据时为NaN
+    lag为None（默认）时按法定披露截止日生效：一季报4月30日、半年报8月31日、三季报10月31日、年报次年4月30日；
+    lag为整数时按报告期后lag个自然日生效，lag=0（报告期当日即可用，存在未来函数）需显式指定（见get_effective_date）
+    例：在initialize()中 self.factors = query.FactorMatrix(self.bars, ['eps','roc'])
+        在handlebar()中 eps = self.factors.get('eps') # 当前交易日全部股票的EPS
+    """
 
-        self.read_csv_files() # 数据初始化
+    def __init__(self, bars, fields=('eps',), lag=None, fundamentals=fundamentals):
+        self.bars = bars
+        self.lag = lag
+        self.fundamentals = fundamentals
+        self.values = {} # 字段名称 -> 日期×代码的二维数组
+        self.build(fields)
 
-    def read_csv_files(self):
+    def build(self, fields):
         """
-        从数据路径中打开CSV文件，转换为DataFrame
+        计算字段的时点截面矩阵，每只股票只读取一次财务数据
         """
-        for sym in self.full_list:
+        fields = [field for field in fields if field not in self.values]
+        if not fields:
+            return
+        dates = self.bars.panel.dates.astype(str)
+        values = {field: np.full((len(dates), len(self.bars.symbol_list)), np.nan) for field in fields}
+        for j, sym in enumerate(self.bars.symbol_list):
             try:
-                df = pd.read_csv('database/mfi_data/%s.csv'%sym,encoding="gbk")
-                self.mfi_data[sym] = df.reset_index(drop=True)
-            except:
-                print("%s is not available in the main financial index data set"%sym)
-
-    def get_eps(self,symbol):
-        df = self.mfi_data[symbol]
-        #df = df[df['post_date'] <= end_date]
-        return(df[['post_date','eps']])
-'''
\ No newline at end of file
+                df = self.fundamentals.load_mfi(sym)[0]
+            except OSError:
+                logger.warning("%s is not available in the main financial index data set",sym)
+                continue
+            effective_date = self.fundamentals.get_effective_date(sym, self.lag)
+            rows = np.searchsorted(effective_date, dates, side='right')-1 # 每个交易日对应的最近一期
+            valid = rows >= 0
+            for field in fields:
+                values[field][valid, j] = df[field].to_numpy(dtype=float)[rows[valid]]
+        self.values.update(values)
+
+    def get(self, field):
+        """
+        获取全部股票当前交易日的字段值，顺序与bars.symbol_list一致
+        """
+        if field not in self.values:
+            self.build([field])
+        return self.values[field][self.bars.bar_index]
+
+    def get_value(self, field, sym):
+        """
+        获取单只股票当前交易日的字段值
+        """
+        return self.get(field)[self.bars.panel.symbol_index[sym]]
+
+# 获取个股所属行业（申万分类）
+def get_industry(symbol):
+    return fundamentals.get_industry(symbol)
+
+# 获取行业成分股（申万分类）
+def get_industry_stock(industry):
+    return fundamentals.get_industry_stock(industry)
+
+# 获取个股EPS：post_date、eps两列，按post_date排序，缺失值（原始数据中的'--'等）为NaN
+def get_eps(symbol):
+    return fundamentals.get_mfi(symbol,['eps'])
+
+# 获取个股ROC：post_date、roc两列，按post_date排序，缺失值为NaN
+def get_roc(symbol):
+    return fundamentals.get_mfi(symbol,['roc'])
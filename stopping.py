@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""
+回测提前终止条件：每根K线更新持仓后检查，任一条件满足时回测终止，保留终止前的持仓及交易记录（部分结果）
+条件通过ContextInfo的stop_conditions设置，基于Portfolio的实时状态及增量风险指标（portfolio.metrics）判断，
+检查开销与回测长度无关；主要用于参数优化时尽早淘汰明显无效的参数组合
+自定义条件继承StopCondition并实现check()；参数优化时条件对象需可被pickle（定义在模块顶层）
+"""
+
+class StopCondition(object):
+    """
+    终止条件接口：check()返回终止原因（字符串），不满足时返回None
+    min_bars为开始检查前的最少K线数，避免回测初期的波动触发终止
+    """
+
+    def __init__(self, min_bars=0):
+        self.min_bars = min_bars
+
+    def __call__(self, port):
+        if port.n_records < self.min_bars:
+            return None
+        return self.check(port)
+
+    def check(self, port):
+        raise NotImplementedError("Should implement check()")
+
+class MaxDrawdownStop(StopCondition):
+    """
+    最大回撤超过limit（如0.5即50%）时终止
+    """
+
+    def __init__(self, limit=0.5, min_bars=0):
+        StopCondition.__init__(self, min_bars)
+        self.limit = limit
+
+    def check(self, port):
+        if port.metrics.max_drawdown > self.limit:
+            return 'max_drawdown %.4f > %.4f'%(port.metrics.max_drawdown, self.limit)
+        return None
+
+class MinNetworthStop(StopCondition):
+    """
+    净值（总资产/初始资金）低于limit时终止
+    """
+
+    def __init__(self, limit=0.5, min_bars=0):
+        StopCondition.__init__(self, min_bars)
+        self.limit = limit
+
+    def check(self, port):
+        networth = port.mkt_value/port.initial_capital
+        if networth < self.limit:
+            return 'networth %.4f < %.4f'%(networth, self.limit)
+        return None
+
+def check_stop(conditions, port):
+    """
+    依次检查全部终止条件，返回第一个满足的终止原因，均不满足时返回None
+    """
+    for condition in conditions:
+        reason = condition(port)
+        if reason is not None:
+            return reason
+    return None
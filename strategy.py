@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 
 from abc import ABCMeta, abstractmethod
+import logging
 
-import ordertype
+import indicator
+import vectorized
+from log import get_logger
 import pandas as pd
 import numpy as np
 
+logger = get_logger('strategy')
+
 class Strategy(object):
     """
     定义Strategy的基类
@@ -13,6 +18,9 @@ class Strategy(object):
 
     __metaclass__ = ABCMeta
 
+    # 策略参数默认值，可由ContextInfo.params覆盖（用于参数优化）
+    params = {}
+
     @abstractmethod
     def __init__(self, events, ContextInfo, bars, portfolio, order):
         self.events = events
@@ -25,6 +33,9 @@ class Strategy(object):
         self.end_date = ContextInfo.end_date
         self.initial_capital = ContextInfo.initial_capital
         self.commission_rate = ContextInfo.commission_rate
+        self.params = dict(self.params, **ContextInfo.params)
+        # 技术指标，在initialize()中注册，在handlebar()中读取当前值
+        self.indicators = indicator.Indicators(bars)
 
     @abstractmethod
     def initialize(self):
@@ -44,35 +55,45 @@ class Strategy(object):
 class SimpleMovingAverage(Strategy):
     """
     一个用于测试的简易多股均线策略，10日均线>30日均线买入，反之卖出
+    参数：short短均线天数，long长均线天数
     """
+    params = {'short':10,'long':30}
+
     def initialize(self):
+        # 均线在初始化时对全部股票一次性计算，新上市股票需满long日数据后才产生信号
+        self.indicators.add('ma_short',indicator.sma,'close',window=self.params['short'])
+        self.indicators.add('ma_long',indicator.sma,'close',window=self.params['long'])
         return
 
     def handlebar(self, event):
         self.event = event
         #print(self.bars.get_latest_bar(self.symbol_list[0])['date_time'])
-        print('[均线策略]日期:',self.portfolio.positions['date_time'])
+        logger.debug('[均线策略]日期：%s',self.portfolio.date_time)
 
         pos_list = self.portfolio.get_positions()
 
-        # 生成调仓列表
+        # 生成调仓列表（股票名称只在输出DEBUG日志时获取）
         list_change = False
+        debug = logger.isEnabledFor(logging.DEBUG)
         for sym in self.bars.symbol_list:
-            name = self.bars.get_latest_bar(sym)['name']
-            ma_10 = self.bars.get_latest_bars(sym,10)['close'].mean()
-            ma_30 = self.bars.get_latest_bars(sym,30)['close'].mean()
+            ma_short = self.indicators.get('ma_short',sym)
+            ma_long = self.indicators.get('ma_long',sym)
 
-            if (ma_10 > ma_30) and (sym not in pos_list):
-                print("[买入信号] Name:",name,"MA10:",ma_10,"MA30:",ma_30)
+            if (ma_short > ma_long) and (sym not in pos_list):
+                if debug:
+                    logger.debug("[买入信号] Name：%s，MA-Short：%s，MA-Long：%s",
+                                 self.bars.get_latest_bar(sym)['name'],ma_short,ma_long)
                 pos_list.append(sym)
                 list_change = True
 
-            if (ma_10 < ma_30) and (sym in pos_list):
-                print("[卖出信号] Name:",name,"MA10:",ma_10, "MA30:",ma_30)
+            if (ma_short < ma_long) and (sym in pos_list):
+                if debug:
+                    logger.debug("[卖出信号] Name：%s，MA-Short：%s，MA-Long：%s",
+                                 self.bars.get_latest_bar(sym)['name'],ma_short,ma_long)
                 pos_list.remove(sym)
                 list_change = True
 
-        print('选股列表：',pos_list)
+        logger.debug('选股列表：%s',pos_list)
         # 如果列表变化，进行调仓
         if list_change:
             # 对不在列表的持仓股票执行卖出
@@ -112,31 +133,32 @@ class MachineLearning(Strategy):
 
         pos = self.portfolio.get_position(sym)
         cash = self.portfolio.get_cash()
-        name = self.bars.get_latest_bar(sym)['name']
 
         # 注意：未对数据做标准化处理，可能产生较大影响
 
         # 训练模型：X为前日pct_chg和volume，Y为当日的pct_chg
-        his_data = self.bars.get_latest_bars(sym,500)
-        pct_chg_train = list(his_data['pct_chg'][:-1])
-        turn_rate_train = list(his_data['turn_rate'][:-1])
-        volume_train = list(his_data['volume'][:-1])
+        pct_chg,turn_rate,volume = self.bars.get_latest_windows(sym,('pct_chg','turn_rate','volume'),500)
+        pct_chg_train = list(pct_chg[:-1])
+        turn_rate_train = list(turn_rate[:-1])
+        volume_train = list(volume[:-1])
         X_train = pd.DataFrame({'pct_chg':pct_chg_train,'volume':volume_train,'turn_rate':turn_rate_train})
-        y_train = list(his_data['pct_chg'][1:])
+        y_train = list(pct_chg[1:])
         # 拟合模型，简单决策树
         model = RandomForestRegressor()
         model.fit(X_train,y_train)
         # 预测模型，基于当日pct_chg和volume
         X_pred = pd.DataFrame({'pct_chg':[pct_chg_train[-1]],'volume':[volume_train[-1]],'turn_rate':[turn_rate_train[-1]]})
         y_pred = model.predict(X_pred)[0]
-        print("预测收益率：",y_pred,"前日实际收益率：",y_train[-1])
+        logger.debug("预测收益率：%s，前日实际收益率：%s",y_pred,y_train[-1])
 
         # 每隔5天调仓，预测收益率>1%则买入，预测收益率<-1则卖出
         if y_pred > 1 and pos == 0 and self.day_count%5 == 0:
-            print("[买入信号] Name:",name,"Predict Returns:",y_pred)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[买入信号] Name：%s，Predict Returns：%s",self.bars.get_latest_bar(sym)['name'],y_pred)
             self.order.order_target_value(sym,cash)
         if y_pred < -1 and pos != 0 and self.day_count%5 == 0:
-            print("[卖出信号] Name:",name,"Predict Returns:",y_pred)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[卖出信号] Name：%s，Predict Returns：%s",self.bars.get_latest_bar(sym)['name'],y_pred)
             self.order.order_target_share(sym,0)
 
         self.day_count += 1 # 策略天数+1
@@ -148,65 +170,57 @@ class RSRS(Strategy):
     （2）将最高价及最低价序列进行OLS线性回归，计算斜率
     （3）取前M日的斜率时间序列，计算当日斜率所处位置的标准分z
     （4）将z与拟合方程的决定系数相乘，作为当日RSRS指标值
+    （5）股票池中每只股票分别择时，买入时按总资产等额分配
+    参数：N回归窗口，M标准分窗口，threshold买卖阈值
     """
-    def initialize(self):
-        from sklearn import linear_model
+    params = {'N':200,'M':100,'threshold':0.9}
 
-        # 单股模型，仅使用列表第一支股票
-        sym = self.bars.symbol_list[0]
-
-        # 计算初始的beta_list，求回测前200日每日的模型beta值，并生成序列
-        self.beta_list = []
-        his_data = self.bars.get_latest_bars(sym,500)
-        for dt in his_data['date_time'][-200:]:
-            #print(dt)
-            # 数据获取：X为前200日每日最低价序列，y为前200日每日最高价序列
-            y_train = his_data[his_data['date_time']<dt]['high'][-200:]
-            X_train = his_data[his_data['date_time']<dt]['low'][-200:]
-            # 拟合模型，OLS简单线性回归
-            model = linear_model.LinearRegression()
-            model.fit(X_train.values.reshape(-1,1),y_train)
-            beta = model.coef_[0] # 计算模型斜率
-            self.beta_list.append(beta)
-        #print(len(self.beta_list))
+    def initialize(self):
+        # 由累计和一次性计算全部股票、全部日期的回归斜率、R²及RSRS指标，不再逐日拟合
+        self.indicators.add(('beta','r2','rsrs'),indicator.rsrs,('low','high'),
+                            window=self.params['N'],z_window=self.params['M'])
         return
 
     def handlebar(self, event):
-        from sklearn import linear_model
-        from sklearn.metrics import r2_score
-
         self.event = event
         #print(self.bars.get_latest_bar(self.symbol_list[0])['date_time'])
         #print(self.portfolio.positions['date_time'])
 
-        # 单股模型，仅使用列表第一支股票
-        sym = self.bars.symbol_list[0]
+        threshold = self.params['threshold']
+        count = len(self.bars.symbol_list)
+        debug = logger.isEnabledFor(logging.DEBUG) # 股票名称只在输出DEBUG日志时获取
+        for sym in self.bars.symbol_list:
+            pos = self.portfolio.get_position(sym)
+            z = self.indicators.get('rsrs',sym)
+
+            # 当前z值大于threshold买入，当前z值小于-threshold卖出
+            if z > threshold and pos == 0:
+                if debug:
+                    logger.debug("[买入信号] Name：%s，Z-Score：%s",self.bars.get_latest_bar(sym)['name'],z)
+                tar_value = min(self.portfolio.get_cash(),self.portfolio.get_mkv()/count)
+                self.order.order_target_value(sym,tar_value)
+            if z < -threshold and pos != 0:
+                if debug:
+                    logger.debug("[卖出信号] Name：%s，Z-Score：%s",self.bars.get_latest_bar(sym)['name'],z)
+                self.order.order_target_share(sym,0)
+
+class TargetWeight(Strategy):
+    """
+    目标权重调仓策略：每个交易日按目标权重矩阵对各股执行order_target_value，NaN表示不调整该股
+    参数：weights目标权重矩阵（见vectorized.align_weights）
+    用于与vectorized.VectorizedBacktest的结果相互校验
+    """
+    params = {'weights':None}
 
-        pos = self.portfolio.get_position(sym)
-        cash = self.portfolio.get_cash()
-        name = self.bars.get_latest_bar(sym)['name']
-
-        # 数据获取：X为前200日每日最低价序列，y为前200日每日最高价序列
-        his_data = self.bars.get_latest_bars(sym,200)
-        y_train = his_data['high']
-        X_train = his_data['low']
-        #print(his_data[''])
-        # 拟合模型，OLS简单线性回归
-        model = linear_model.LinearRegression()
-        model.fit(X_train.values.reshape(-1,1),y_train)
-        beta = model.coef_[0] # 计算模型斜率
-        r2 = model.score(X_train.values.reshape(-1,1),y_train)
-        self.beta_list.append(beta)
-
-        # 根据前100日的beta序列数据，计算标准分位数z
-        sd = np.std(self.beta_list[-100:])
-        m = np.mean(self.beta_list[-100:])
-        z = r2*(beta-m)/sd
-
-        # 当前z值大于0.9买入，当前z值小于0.9卖出
-        if z > 0.9 and pos == 0:
-            print("[买入信号] Name:",name,"Z-Score:",z)
-            self.order.order_target_value(sym,cash)
-        if z < -0.9 and pos != 0:
-            print("[卖出信号] Name:",name,"Z-Score:",z)
-            self.order.order_target_share(sym,0)
\ No newline at end of file
+    def initialize(self):
+        self.weights = vectorized.align_weights(self.params['weights'],self.bars)
+        return
+
+    def handlebar(self, event):
+        self.event = event
+        i = self.bars.bar_index
+        w = self.weights[i]
+        listed = self.bars.panel.listed[i,:len(self.bars.symbol_list)]
+        mkv = self.portfolio.get_mkv()
+        for j in np.flatnonzero(listed & ~np.isnan(w)):
+            self.order.order_target_value(self.bars.symbol_list[j],w[j]*mkv)
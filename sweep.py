@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+参数优化（网格搜索、逐次减半）及滚动窗口（Walk-Forward）回测：
+行情数据只加载一次并放入共享内存，各次回测在进程池中并行执行，汇总绩效指标为一张结果表
+ContextInfo中设置了stop_conditions（见stopping模块）时，触发终止条件的回测提前结束，
+进程立即处理下一个任务，结果表中stop_reason为终止原因（完整回测为None）
+"""
+
+import copy
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import data
+import analysis
+import backtest
+from log import get_logger
+
+logger = get_logger('sweep')
+
+# 子进程中共享的行情面板数据，由_init_worker设置
+_panel = None
+
+def _init_worker(handle):
+    """
+    子进程初始化：映射共享内存中的行情面板数据
+    """
+    global _panel
+    _panel = data.MarketPanel.from_shared(handle)
+
+def _run_backtest(ContextInfo, Strategy, params, start_date=None, end_date=None, equity=False):
+    """
+    子进程中执行单次回测，返回参数及绩效指标
+    start_date/end_date不为空时覆盖ContextInfo中的回测区间；equity为True时同时返回每日总资产
+    """
+    ContextInfo = copy.copy(ContextInfo)
+    ContextInfo.symbol_list = list(ContextInfo.symbol_list)
+    ContextInfo.params = dict(ContextInfo.params, **params)
+    if start_date is not None:
+        ContextInfo.start_date = start_date
+    if end_date is not None:
+        ContextInfo.end_date = end_date
+    bt = backtest.backtest(ContextInfo, Strategy, _panel)
+    bt.run()
+    result = dict(params)
+    result.update(analysis.cal_performance(bt.portfolios, ContextInfo.benchmark))
+    result['stop_reason'] = bt.stop_reason
+    if equity:
+        result['equity'] = list(zip(bt.portfolios.get_dates(), bt.portfolios.get_equity()))
+    return result
+
+def _map(pool, tasks):
+    """
+    在进程池中并行执行回测任务，按任务顺序返回结果
+    """
+    futures = [pool.submit(_run_backtest, *args, **kwargs) for args, kwargs in tasks]
+    return [f.result() for f in futures]
+
+class ParameterSweep(object):
+    """
+    参数网格搜索
+    param_grid为{参数名:取值列表}，对全部参数组合分别回测
+    max_workers为进程数，默认使用全部CPU核心
+    """
+
+    def __init__(self, ContextInfo, Strategy, param_grid, max_workers=None):
+        self.ContextInfo = ContextInfo
+        self.Strategy = Strategy
+        self.param_grid = param_grid
+        self.max_workers = max_workers
+        self.results = None
+
+    def get_combinations(self):
+        """
+        生成全部参数组合，每个组合为一个Dict
+        """
+        keys = list(self.param_grid.keys())
+        return [dict(zip(keys, values)) for values in itertools.product(*[self.param_grid[k] for k in keys])]
+
+    def load_panel(self):
+        """
+        加载回测使用的行情面板数据（只加载一次）
+        """
+        bars = data.HistoricDataHandler(None, self.ContextInfo)
+        return bars.panel
+
+    def run(self):
+        """
+        执行参数优化，返回结果表（DataFrame），每行为一个参数组合及其绩效指标
+        """
+        panel = self.load_panel()
+        handle, blocks = panel.to_shared()
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker,
+                                     initargs=(handle,)) as pool:
+                tasks = [((self.ContextInfo, self.Strategy, params), {}) for params in self.get_combinations()]
+                results = _map(pool, tasks)
+        finally: # 释放共享内存
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+        self.results = pd.DataFrame(results)
+        return self.results
+
+class SuccessiveHalving(ParameterSweep):
+    """
+    逐次减半（Successive Halving）参数搜索
+    回测区间分为n_rungs级，第r级回测前eta**(r-n_rungs+1)的交易日（最后一级为完整区间）；
+    每级的全部候选在进程池中并行回测，触发终止条件的组合直接淘汰，其余按opt_metric保留前1/eta进入下一级
+    大部分组合只回测较短的区间，节省的算力用于存活组合的完整回测
+    结果表每行为一个参数组合在其到达的最后一级的绩效指标，rung为该级编号（n_rungs-1为完整区间）
+    """
+
+    def __init__(self, ContextInfo, Strategy, param_grid, n_rungs=3, eta=2, opt_metric='sharpe_ratio',
+                 max_workers=None):
+        ParameterSweep.__init__(self, ContextInfo, Strategy, param_grid, max_workers)
+        self.n_rungs = n_rungs
+        self.eta = eta
+        self.opt_metric = opt_metric
+
+    def get_rungs(self, dates):
+        """
+        根据交易日序列计算各级回测的结束日期
+        """
+        dates = dates[(dates >= self.ContextInfo.start_date) & (dates <= self.ContextInfo.end_date)]
+        rungs = []
+        for r in range(self.n_rungs):
+            n = max(int(np.ceil(len(dates)*float(self.eta)**(r-self.n_rungs+1))), 1)
+            rungs.append(str(dates[n-1]))
+        return rungs
+
+    def run(self):
+        """
+        执行逐次减半参数搜索，返回结果表（DataFrame），顺序与get_combinations()一致
+        """
+        panel = self.load_panel()
+        rungs = self.get_rungs(panel.dates)
+        combinations = self.get_combinations()
+        results = [None]*len(combinations)
+        candidates = list(range(len(combinations))) # 当前存活的参数组合序号
+        handle, blocks = panel.to_shared()
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker,
+                                     initargs=(handle,)) as pool:
+                for r, end_date in enumerate(rungs):
+                    tasks = [((self.ContextInfo, self.Strategy, combinations[k]), {'end_date': end_date})
+                             for k in candidates]
+                    for k, result in zip(candidates, _map(pool, tasks)):
+                        result['rung'] = r
+                        results[k] = result
+                    if r == len(rungs)-1:
+                        break
+
+                    # 淘汰触发终止条件的组合，其余按opt_metric排序保留前1/eta
+                    alive = [k for k in candidates if results[k]['stop_reason'] is None]
+                    score = lambda k: -np.inf if np.isnan(results[k][self.opt_metric]) else results[k][self.opt_metric]
+                    alive.sort(key=score, reverse=True)
+                    candidates = sorted(alive[:max(int(len(candidates)/self.eta), 1)])
+                    if not candidates:
+                        break
+        finally: # 释放共享内存
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+        self.results = pd.DataFrame(results)
+        return self.results
+
+class WalkForward(ParameterSweep):
+    """
+    滚动窗口（Walk-Forward）回测
+    将回测区间按交易日依次划分为训练窗口（train_days）及紧随其后的测试窗口（test_days），
+    窗口每次向后滚动test_days个交易日
+    param_grid不为空时，在每个训练窗口上做网格搜索，选取opt_metric最大的参数回测测试窗口；
+    为空时直接以默认参数回测各测试窗口
+    各窗口共用同一份共享内存中的行情数据，窗口之前的历史数据用于initialize()的预热，
+    全部回测在进程池中并行执行；结果为拼接后的测试期净值曲线及各窗口的绩效指标
+    训练窗口中触发终止条件或opt_metric为NaN的组合不参与选择；全部组合均无效时沿用上一窗口的参数
+    （第一个窗口为默认参数），selection列记录各窗口参数的来源
+    """
+
+    def __init__(self, ContextInfo, Strategy, train_days=504, test_days=126, param_grid=None,
+                 opt_metric='sharpe_ratio', max_workers=None):
+        ParameterSweep.__init__(self, ContextInfo, Strategy, param_grid or {}, max_workers)
+        self.train_days = train_days
+        self.test_days = test_days
+        self.opt_metric = opt_metric
+        self.networth = None
+
+    def get_windows(self, dates):
+        """
+        根据交易日序列划分窗口，返回[(训练开始,训练结束,测试开始,测试结束)]日期列表
+        """
+        dates = dates[(dates >= self.ContextInfo.start_date) & (dates <= self.ContextInfo.end_date)]
+        windows = []
+        for i in range(self.train_days, len(dates), self.test_days):
+            test_end = min(i+self.test_days, len(dates))-1
+            windows.append((str(dates[i-self.train_days]), str(dates[i-1]), str(dates[i]), str(dates[test_end])))
+        return windows
+
+    def run(self):
+        """
+        执行滚动窗口回测，返回拼接后的测试期净值曲线（DataFrame），各窗口的绩效指标保存在results中
+        """
+        panel = self.load_panel()
+        windows = self.get_windows(panel.dates)
+        handle, blocks = panel.to_shared()
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker,
+                                     initargs=(handle,)) as pool:
+                # 在各训练窗口上并行做网格搜索，选取最优参数
+                combinations = self.get_combinations() if self.param_grid else []
+                best_params = [{} for _ in windows]
+                selection = ['default' if not combinations else 'single' for _ in windows]
+                if len(combinations) > 1:
+                    tasks = [((self.ContextInfo, self.Strategy, params),
+                              {'start_date': train_start, 'end_date': train_end})
+                             for train_start, train_end, _, _ in windows for params in combinations]
+                    train_results = _map(pool, tasks)
+                    for k in range(len(windows)):
+                        scores = np.array([np.nan if r['stop_reason'] is not None else r[self.opt_metric]
+                                           for r in train_results[k*len(combinations):(k+1)*len(combinations)]],
+                                          dtype=float)
+                        if np.isnan(scores).all(): # 全部组合无效，沿用上一窗口的参数
+                            best_params[k] = best_params[k-1] if k > 0 else {}
+                            selection[k] = 'previous' if k > 0 else 'default'
+                            logger.warning("[WalkForward]window %d has no valid %s in training, using %s parameters",
+                                           k, self.opt_metric, selection[k])
+                        else:
+                            best_params[k] = combinations[int(np.nanargmax(scores))]
+                            selection[k] = 'best'
+                elif combinations:
+                    best_params = [combinations[0] for _ in windows]
+
+                # 以选定的参数并行回测各测试窗口
+                tasks = [((self.ContextInfo, self.Strategy, params),
+                          {'start_date': test_start, 'end_date': test_end, 'equity': True})
+                         for (_, _, test_start, test_end), params in zip(windows, best_params)]
+                test_results = _map(pool, tasks)
+        finally: # 释放共享内存
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+        # 拼接测试期净值：每个窗口的净值以上一窗口的期末净值为起点
+        networth = []
+        base = 1.
+        for k, result in enumerate(test_results):
+            equity = result.pop('equity')
+            for date_time, mkt_value in equity:
+                networth.append((k, date_time, base*mkt_value/self.ContextInfo.initial_capital))
+            base = networth[-1][2]
+        self.networth = pd.DataFrame(networth, columns=['window', 'date_time', 'networth'])
+
+        results = []
+        for k, ((train_start, train_end, test_start, test_end), result) in enumerate(zip(windows, test_results)):
+            row = {'window': k, 'train_start': train_start, 'train_end': train_end,
+                   'test_start': test_start, 'test_end': test_end, 'selection': selection[k]}
+            row.update(result)
+            results.append(row)
+        self.results = pd.DataFrame(results)
+        return self.networth
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""
+向量化回测：适用于可以表示为目标权重矩阵（日期×代码）的策略，如均线择时、等权调仓
+不经过事件循环及逐笔委托，每个交易日对全部代码一次性计算委托数量，由matching.match_orders批量撮合
+撮合规则与broker.SimulatedExecution一致：停牌不成交、涨停不买跌停不卖（±9.98%）、委托数量向下取整百、
+手续费不低于最低手续费，先卖后买，买入按代码顺序检查可用资金
+回测结果保存在portfolio.Portfolio中，可直接用于analysis的绩效分析；
+与事件驱动回测中的strategy.TargetWeight策略结果一致，可由compare_engines相互校验（python vectorized.py）
+注意：持仓、现金逐日依赖前一日，按日期循环，每日内按代码向量化
+"""
+
+import copy
+import time
+
+import numpy as np
+import pandas as pd
+
+import data
+import portfolio
+import matching
+import analysis
+import stopping
+from log import get_logger, RejectCode, RejectionLog
+
+logger = get_logger('vectorized')
+
+def align_weights(weights, bars):
+    """
+    将目标权重对齐为面板数据的日期×symbol_list二维数组，NaN表示当日不调整该股
+    weights为DataFrame（行为日期，列为代码）或形状一致的二维数组
+    """
+    if isinstance(weights, pd.DataFrame):
+        weights = weights.copy()
+        weights.index = weights.index.astype(str)
+        weights = weights.reindex(index=bars.panel.dates, columns=bars.symbol_list)
+        return weights.to_numpy(dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    shape = (len(bars.panel.dates), len(bars.symbol_list))
+    if weights.shape != shape:
+        raise ValueError("weights shape %s does not match the panel %s"%(weights.shape, shape))
+    return weights
+
+def equal_weight(signal):
+    """
+    将持仓信号（True/1为持有）转换为等权目标权重，当日无持仓信号时空仓
+    """
+    if isinstance(signal, pd.DataFrame):
+        return pd.DataFrame(equal_weight(signal.to_numpy()), index=signal.index, columns=signal.columns)
+    signal = np.nan_to_num(np.asarray(signal, dtype=float))
+    count = signal.sum(axis=1, keepdims=True)
+    return np.divide(signal, count, out=np.zeros(signal.shape), where=count > 0)
+
+class VectorizedBacktest(object):
+    """
+    向量化回测，weights为目标权重矩阵（见align_weights）
+    每个交易日按收盘时的总资产计算目标市值，委托价为收盘价
+    """
+
+    def __init__(self, ContextInfo, weights, panel=None):
+        self.ContextInfo = ContextInfo
+        self.weights = weights
+        self.panel = panel # 已加载的行情面板数据，为None时从磁盘读取
+        self.stop_reason = None # 提前终止的原因（终止条件见ContextInfo.stop_conditions）
+
+    def execute(self, i, cols, qty, price):
+        """
+        撮合当日的全部委托（见matching.match_orders）并更新持仓，记录成交及拒绝记录
+        """
+        panel = self.bars.panel
+        amount, fill_price, commission, code = matching.match_orders(
+            cols, qty, price, panel.fields['close'][i], panel.fields['pct_chg'][i], panel.suspended[i],
+            self.port.positions, self.port.cash, self.ContextInfo.commission_rate, self.ContextInfo.min_commission)
+        bar_date = panel.dates[i]
+        filled = code == 0
+        if filled.any():
+            cost = fill_price[filled]*amount[filled]+commission[filled]
+            self.port.update_fills(cols[filled], amount[filled], cost)
+            self.records.append((np.full(filled.sum(), bar_date), cols[filled], fill_price[filled],
+                                 amount[filled], commission[filled]))
+        for k in np.flatnonzero(~filled):
+            # 停牌及涨跌停在取整前拒绝，记录原委托数量
+            order_amount = qty[k] if code[k] <= RejectCode.LIMIT_DOWN else amount[k]
+            self.rejections.append(bar_date, self.bars.symbol_list[cols[k]], RejectCode(code[k]),
+                                   fill_price[k], order_amount)
+
+    def run(self):
+        self.t0 = time.time() # 回测起始时间
+        self.timings = {} # 各阶段耗时（秒），与backtest.backtest.timings一致
+        t = time.perf_counter()
+        self.bars = data.HistoricDataHandler(None, self.ContextInfo, self.panel)
+        self.timings['load'] = time.perf_counter()-t
+        t = time.perf_counter()
+        self.port = portfolio.Portfolio(None, self.ContextInfo, self.bars)
+        self.records = []
+        self.rejections = RejectionLog()
+        weights = align_weights(self.weights, self.bars)
+        panel = self.bars.panel
+        n = len(self.bars.symbol_list)
+        close = panel.fields['close'][:, :n]
+        tradable = panel.listed[:, :n] & ~np.isnan(weights)
+        stop_conditions = self.ContextInfo.stop_conditions
+        self.stop_reason = None
+        self.timings['initialize'] = time.perf_counter()-t
+        logger.info("[Initialized]Time: %.2f", time.time()-self.t0)
+
+        t = time.perf_counter()
+        for i in range(self.bars.bar_index+1, self.bars.last_index+1):
+            self.bars.bar_index = i
+            self.port.update_portfolios()
+            if stop_conditions:
+                self.stop_reason = stopping.check_stop(stop_conditions, self.port)
+                if self.stop_reason is not None:
+                    logger.info("[Backtest Stopped]%s %s", self.port.date_time, self.stop_reason)
+                    break
+
+            # 计算目标市值与当前市值之差对应的委托数量，与ordertype.order_target_value一致
+            cols = np.flatnonzero(tradable[i])
+            if len(cols) == 0:
+                continue
+            price = close[i, cols]
+            qty = (weights[i, cols]*self.port.mkt_value-self.port.positions[cols]*price)/price
+            # 先卖后买，与事件驱动回测的处理顺序一致
+            order = np.concatenate((np.flatnonzero(qty < 0), np.flatnonzero(qty >= 100)))
+            if len(order) > 0:
+                self.execute(i, cols[order], qty[order], price[order])
+
+        self.timings['loop'] = time.perf_counter()-t
+        self.portfolios = self.port
+        logger.info("[Backtest Finished]Time: %.2f", time.time()-self.t0)
+
+    @property
+    def execution_records(self):
+        """
+        交易记录，格式与broker.SimulatedExecution.execution_records一致
+        """
+        records = []
+        for dates, cols, price, amount, commission in self.records:
+            for d, j, p, a, c in zip(dates, cols, price, amount, commission):
+                records.append({'date_time': d, 'symbol': self.bars.symbol_list[j], 'order_price': p,
+                                'order_amount': a, 'commission': c})
+        return records
+
+    # 导出回测数据
+    def download_data(self):
+        self.portfolios.download_portfolios()
+        pd.DataFrame(self.execution_records).to_csv('logs/execution_records.csv')
+        self.rejections.download('logs/rejection_records.csv')
+
+    # 生成绩效分析
+    def get_performance(self):
+        report = analysis.PerformanceReport(self.portfolios, self.ContextInfo.benchmark)
+        report.output()
+        report.draw_plot()
+
+def compare_engines(ContextInfo, weights, panel=None):
+    """
+    以相同的目标权重分别运行事件驱动回测（strategy.TargetWeight）及向量化回测，
+    校验两者每日持仓、现金、总资产及成交记录完全一致，不一致时抛出AssertionError
+    返回(事件驱动回测, 向量化回测)
+    """
+    import backtest, strategy # backtest -> strategy -> vectorized，在此导入避免循环导入
+    if panel is None: # 两个引擎共用同一份行情数据
+        context = copy.copy(ContextInfo)
+        context.symbol_list = list(ContextInfo.symbol_list)
+        panel = data.HistoricDataHandler(None, context).panel
+
+    context = copy.copy(ContextInfo)
+    context.symbol_list = list(ContextInfo.symbol_list)
+    context.params = dict(ContextInfo.params, weights=weights)
+    bt = backtest.backtest(context, strategy.TargetWeight, panel)
+    bt.run()
+    context = copy.copy(ContextInfo)
+    context.symbol_list = list(ContextInfo.symbol_list)
+    vb = VectorizedBacktest(context, weights, panel)
+    vb.run()
+
+    event_port, vec_port = bt.portfolios, vb.portfolios
+    assert np.array_equal(event_port.get_dates(), vec_port.get_dates()), "trading dates differ"
+    assert np.array_equal(event_port.get_history(), vec_port.get_history()), "positions differ"
+    assert np.array_equal(event_port.all_cash[:event_port.n_records], vec_port.all_cash[:vec_port.n_records]), \
+        "cash differs"
+    assert np.array_equal(event_port.get_equity(), vec_port.get_equity()), "equity differs"
+    event_records = pd.DataFrame(bt.broker.execution_records, columns=['date_time', 'symbol', 'order_price',
+                                                                       'order_amount', 'commission'])
+    vec_records = pd.DataFrame(vb.execution_records, columns=event_records.columns)
+    assert len(event_records) == len(vec_records), "number of fills differs"
+    for col in event_records.columns:
+        assert (event_records[col].to_numpy() == vec_records[col].to_numpy()).all(), "fills differ in %s"%col
+    return bt, vb
+
+if __name__ == '__main__':
+    import backtest
+
+    # 交叉校验：沪深300指数及个股每21个交易日等权调仓，事件驱动回测与向量化回测的结果应完全一致
+    sym_pool = ['600030.SH','000001.SZ','600999.SH','399300.SZ']
+    dict_CI = {"symbol_list":sym_pool,
+               'benchmark':'399300.SZ',
+               'start_date':'2008-01-01',
+               'end_date':'2020-07-31',
+               'initial_capital':10000000,
+               'commission_rate':0.0003,
+               'min_commission':5}
+    dates = pd.bdate_range(dict_CI['start_date'], dict_CI['end_date'], freq='21B').strftime('%Y-%m-%d')
+    weights = pd.DataFrame(0.24, index=dates, columns=sym_pool)
+    bt, vb = compare_engines(backtest.ContextInfo(dict_CI), weights)
+    print('=====事件驱动与向量化回测结果一致=====')
+    print('交易天数：%d，成交笔数：%d，期末总资产：%.2f'%(vb.portfolios.n_records, len(vb.execution_records),
+                                                vb.portfolios.get_equity()[-1]))